@@ -0,0 +1,232 @@
+""" benchmarks of the update pipeline on synthetic data.
+
+    python bench.py records [record_count]
+    python bench.py writers [shard_count] [record_count]
+    python bench.py formats [series_count]
+"""
+import gc
+import gzip
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from config import MAX_DATA_PER_BATCH, SHARD_WRITERS_MAX_OPEN, SHARD_WRITERS_BUFFER_BYTES
+from formats import JSON, COLUMNAR, CSV, BINARY, render
+from records import FootnoteTable, RecordBatch, format_record, parse_footnotes
+from update import array_to_json
+from writers import ShardWriters
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ['M%02d' % i for i in range(1, 14)]
+
+
+def log(*args):
+    s = " ".join([str(i) for i in args])
+    logger.log(logging.INFO, s)
+
+
+def synthetic_records(count, seed=1):
+    """ generator, returns SM-like data records: ~40 years of monthly data per series, some revisions duplicated """
+    rnd = random.Random(seed)
+    per_series = 40 * len(PERIODS)
+    n = 0
+    series = 0
+    while n < count:
+        series_id = 'SMU%02d%05d%08d01' % (series % 50, series % 99999, series)
+        for year in range(1980, 1980 + per_series // len(PERIODS)):
+            for period in PERIODS:
+                footnotes = parse_footnotes('P' if rnd.random() < 0.01 else '')
+                yield series_id, year, period, footnotes, round(rnd.uniform(0, 10000), 1)
+                n += 1
+                if n >= count:
+                    return
+        series += 1
+
+
+class GcTimer:
+
+    def __init__(self):
+        self.total = 0
+        self.started = None
+
+    def __call__(self, phase, info):
+        if phase == 'start':
+            self.started = time.perf_counter()
+        elif self.started is not None:
+            self.total += time.perf_counter() - self.started
+
+    def __enter__(self):
+        gc.callbacks.append(self)
+        return self
+
+    def __exit__(self, *args):
+        gc.callbacks.remove(self)
+
+
+def legacy_shard(path, records):
+    """ previous implementation: json dict per record, sorted and deduplicated as dicts """
+    with gzip.open(path, 'wt') as f:
+        for r in records:
+            f.write(json.dumps({
+                'series_id': r[0], 'year': r[1], 'period': r[2], 'footnote_codes': list(r[3]), 'value': r[4]
+            }) + "\n")
+    with gzip.open(path, 'rt') as f:
+        data = f.read()
+    data = data.split('\n')[:-1]
+    data = '[\n' + ',\n'.join(data) + ']'
+    data = json.loads(data)
+    data.sort(key=lambda i: (i['series_id'], i['year'], i['period']))
+    result = []
+    for s in itertools.groupby(data, key=lambda i: i['series_id']):
+        series = [next(i[1]) for i in itertools.groupby(s[1], key=lambda i: (i['year'], i['period']))]
+        for i in series:
+            del i['series_id']
+        result.append((s[0], zlib.crc32(array_to_json(series).encode())))
+    return result
+
+
+def compact_shard(path, records):
+    footnotes = FootnoteTable()
+    with gzip.open(path, 'wt') as f:
+        for r in records:
+            f.write(format_record(r, footnotes))
+    batch = RecordBatch(False, footnotes)
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            batch.add_line(line)
+    result = []
+    for series_id, order in batch.sorted_series():
+        result.append((series_id, zlib.crc32(array_to_json([batch.to_dict(i) for i in order]).encode())))
+    return result
+
+
+def measure(fn, path, records):
+    gc.collect()
+    with GcTimer() as gc_timer:
+        started = time.perf_counter()
+        result = fn(path, records)
+        elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    fn(path, records)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, gc_timer.total, peak
+
+
+def bench_records(count=MAX_DATA_PER_BATCH):
+    """ peak memory and time of sorting and deduplicating one data shard """
+    # a shard is routed from several data files, the revised second copy plays the role of data.1.AllData
+    records = list(synthetic_records(count // 2))
+    records = records + [r[:4] + (r[4] + 1,) for r in records[:count - len(records)]]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'shard.gz')
+        results = []
+        for name, fn in [('dict', legacy_shard), ('compact', compact_shard)]:
+            result, elapsed, gc_time, peak = measure(fn, path, records)
+            results.append(result)
+            log("%-8s records: %d time: %.2fs gc: %.2fs peak memory: %.1f MB"
+                % (name, count, elapsed, gc_time, peak / 1024 / 1024))
+        log("same output:", results[0] == results[1])
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def route_open_all(paths, records, footnotes, on_sample):
+    """ previous implementation: one open gzip writer per shard """
+    fds = [gzip.open(p, 'wt') for p in paths]
+    for n, r in enumerate(records):
+        fds[zlib.crc32(r[0].encode()) % len(fds)].write(format_record(r, footnotes))
+        if n % 10000 == 0:
+            on_sample()
+    on_sample()
+    for fd in fds:
+        fd.close()
+
+
+def route_pooled(paths, records, footnotes, on_sample):
+    with ShardWriters(paths) as writers:
+        for n, r in enumerate(records):
+            writers.write(paths[zlib.crc32(r[0].encode()) % len(paths)], format_record(r, footnotes))
+            if n % 10000 == 0:
+                on_sample()
+        on_sample()
+
+
+def run_routing(name, shard_count, count):
+    """ runs in a fresh process, returns time, peak rss and peak count of open files of one routing pass """
+    fn = {'open_all': route_open_all, 'pooled': route_pooled}[name]
+    fds = [open_fds()]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def on_sample():
+        fds.append(open_fds())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, 'shard.%d.tsv.gz' % i) for i in range(shard_count)]
+        started = time.perf_counter()
+        fn(paths, synthetic_records(count), FootnoteTable(), on_sample)
+        elapsed = time.perf_counter() - started
+        content = sum(len(gzip.open(p).read()) for p in paths)
+    return elapsed, rss_before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, fds[0], max(fds), content
+
+
+def bench_writers(shard_count=500, count=MAX_DATA_PER_BATCH):
+    """ peak rss and open files of routing records to shard files, records of a series are spread over shards """
+    log("max open writers:", SHARD_WRITERS_MAX_OPEN, "buffer: %d MB" % (SHARD_WRITERS_BUFFER_BYTES // 1024 // 1024))
+    for name in ['open_all', 'pooled']:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            elapsed, rss_before, rss, fds_before, fds, content = \
+                executor.submit(run_routing, name, shard_count, count).result()
+        log("%-8s shards: %d records: %d time: %.2fs peak rss: %.1f MB (+%.1f MB) open files: %d (+%d) bytes: %d"
+            % (name, shard_count, count, elapsed, rss / 1024, (rss - rss_before) / 1024, fds, fds - fds_before,
+               content))
+
+
+def bench_formats(series_count=1000):
+    """ serialization time and size of data responses per format """
+    per_series = 40 * len(PERIODS)
+    records = synthetic_records(series_count * per_series)
+    responses = [[{'year': r[1], 'period': r[2], 'footnote_codes': list(r[3]), 'value': r[4]} for r in s[1]]
+                 for s in itertools.groupby(records, key=lambda r: r[0])]
+    formats = [
+        ('pretty', lambda obs: json.dumps(obs, indent=2, sort_keys=True)),  # jsonify with DEBUG
+        (JSON, lambda obs: render(obs, JSON)),
+        (COLUMNAR, lambda obs: render(obs, COLUMNAR)),
+        (CSV, lambda obs: render(obs, CSV)),
+        (BINARY, lambda obs: render(obs, BINARY)),
+    ]
+    for name, fn in formats:
+        started = time.perf_counter()
+        bodies = [fn(obs) for obs in responses]
+        elapsed = time.perf_counter() - started
+        bodies = [b.encode() if isinstance(b, str) else b for b in bodies]
+        size = sum(len(b) for b in bodies)
+        gzipped = sum(len(gzip.compress(b)) for b in bodies)
+        log("%-8s responses: %d time: %.3fs %.1f us/response bytes/response: %d gzipped: %d"
+            % (name, len(bodies), elapsed, elapsed / len(bodies) * 1e6, size // len(bodies), gzipped // len(bodies)))
+
+
+if __name__ == '__main__':
+    benchmarks = {
+        'records': bench_records,
+        'writers': bench_writers,
+        'formats': bench_formats,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        log("usage: python bench.py", "|".join(benchmarks.keys()), "[args]")
+        exit(1)
+    benchmarks[sys.argv[1]](*[int(i) for i in sys.argv[2:]])
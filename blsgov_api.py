@@ -4,21 +4,29 @@ import gzip
 import io
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
+import threading
+import time
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import cmp_to_key
+from html.parser import HTMLParser
 
-from pyquery import PyQuery
-
-from config import REGISTRATION_KEY, WORK_DIR
-from http_api import load_with_retry, load_file
+from config import REGISTRATION_KEY, WORK_DIR, DISCOVERY_WORKERS, FILE_LIST_TTL, PIPELINED_DOWNLOAD, \
+    APPROX_SERIES_LINE_BYTES, APPROX_DATA_LINE_BYTES, LINE_SAMPLE_BYTES, PARSE_WORKERS, PARSE_CHUNK_BYTES, \
+    PARSE_PARALLEL_MIN_BYTES
+from http_api import load_with_retry, load_file, open_stream, start_stream, decode_str
+from records import parse_header, parse_record, parse_chunk, read_chunks
 
 BASE_FILE_URL = 'https://download.bls.gov/pub/time.series/'
 BASE_API_URL = 'https://api.bls.gov/publicAPI/v2/'
 
 REDOWNLOAD = True  # should be True
+DONE_SUFFIX = '.done'
 
 logger = logging.getLogger(__name__)
 
@@ -55,15 +63,18 @@ def load_db_list():
     dbs = {**dbs, **dbs2}
 
     missed = [i for i in dbs.keys() if get_loader(i) is None]
-    dbs = [{"id": i[0], "name": i[1], "modified": get_loader(i[0]).get_last_modification().isoformat()}
-           for i in dbs.items() if get_loader(i[0]) is not None]
+    found = [(i[0], i[1], get_loader(i[0])) for i in dbs.items() if get_loader(i[0]) is not None]
+
+    with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as executor:
+        modified = list(executor.map(lambda i: i[2].get_last_modification(), found))
+    dbs = [{"id": i[0], "name": i[1], "modified": m.isoformat()} for i, m in zip(found, modified)]
 
     log("loaders not found for:", missed)
     return dbs
 
 
 def get_loader(db_id):
-    return next((l for l in loaders if l.db_id == db_id), None)
+    return loaders_by_id.get(db_id)
 
 
 class AbstractDbLoader(abc.ABC):
@@ -74,10 +85,14 @@ class AbstractDbLoader(abc.ABC):
     def __init__(self, db_id):
         self.db_id = db_id
         self.work_dir = os.path.join(WORK_DIR, 'tmp', 'download', db_id.lower())
+        self.file_list = None
+        self.file_list_time = None
+        self.file_list_lock = threading.Lock()
+        self.parse_pool = None
 
-    def get_last_modification(self):
+    def get_last_modification(self, max_age=FILE_LIST_TTL):
         """ returns last modification date """
-        ff = self.load_file_list()
+        ff = self.load_file_list(max_age)
         if len(ff) < 1:
             return datetime.datetime(1900, 1, 1, tzinfo=None)
         else:
@@ -88,6 +103,22 @@ class AbstractDbLoader(abc.ABC):
         """ download data for parsing """
         pass
 
+    def get_parse_pool(self):
+        """ returns the process pool of chunk parsers, created on first use and kept until close_parse_pool.
+
+        Workers are spawned, not forked: the updater runs threads (downloads, discovery, the daemon) whose
+        locks a forked child would inherit in whatever state they are.
+        """
+        if self.parse_pool is None:
+            self.parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+        return self.parse_pool
+
+    def close_parse_pool(self):
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+
     def clear(self):
         """ clear loaded data """
         if not REDOWNLOAD:
@@ -109,12 +140,12 @@ class AbstractDbLoader(abc.ABC):
 
     @abc.abstractmethod
     def parse_data(self):
-        """ generator, returns parsed_data """
+        """ generator, returns data records (tuples, see records.py) """
         pass
 
     @abc.abstractmethod
     def parse_aspect(self):
-        """ generator, returns parsed_aspects """
+        """ generator, returns aspect records (tuples, see records.py) """
         pass
 
     @abc.abstractmethod
@@ -125,19 +156,30 @@ class AbstractDbLoader(abc.ABC):
     def approx_series_count(self):
         pass
 
-    def load_file_list(self):
+    def load_file_list(self, max_age=FILE_LIST_TTL):
+        """ returns listing of the db directory, cached for max_age seconds """
+        with self.file_list_lock:
+            if self.file_list is None or time.time() - self.file_list_time > max_age:
+                files = self.fetch_file_list()
+                if len(files) == 0:
+                    return []
+                self.file_list = files
+                self.file_list_time = time.time()
+            return [dict(f) for f in self.file_list]
+
+    def fetch_file_list(self):
         try:
             sl = self.db_id.lower()
             file_url = BASE_FILE_URL + sl + "/"
             txt = load_with_retry(file_url)
-            pq = PyQuery(txt)
-            pq = pq('a')
+            parser = FileListParser()
+            parser.feed(txt)
+            parser.close()
             files = []
-            for a in pq[1:]:
-                name = a.attrib['href'].split('/')[-1]
+            for href, prvtxt in parser.links[1:]:
+                name = href.split('/')[-1]
                 if not name.lower().startswith(sl + self.file_prefix_delimiter):
                     continue
-                prvtxt = PyQuery(a).prev()[0].tail
                 prvtxt = prvtxt.split()
                 f = {
                     "name": name[len(sl) + len(self.file_prefix_delimiter):],
@@ -153,13 +195,87 @@ class AbstractDbLoader(abc.ABC):
     def download_file(self, f, use_gzip):
         url = BASE_FILE_URL + self.db_id.lower() + "/" + self.db_id.lower() + self.file_prefix_delimiter + f['name']
         file_name = os.path.join(self.work_dir, f['name'] + ('.gz' if use_gzip else ''))
-        if not os.path.exists(file_name) or REDOWNLOAD:
+        if not self.is_downloaded(f, file_name):
+            remove_file(file_name + DONE_SUFFIX)
             load_file(url, file_name, use_gzip)
+            self.mark_downloaded(f, file_name, os.path.getsize(file_name))
         f['path'] = file_name
         f['open'] = (lambda mode : gzip.open(file_name, mode)) if use_gzip else (lambda mode : io.open(file_name, mode))
 
+    def stream_file(self, f, next_file=None):
+        """ like download_file(f, True), but the file is downloaded on the first open while it is being read.
+
+        Opening f also starts the download of next_file, so it arrives while f is parsed.
+        """
+        url = BASE_FILE_URL + self.db_id.lower() + "/" + self.db_id.lower() + self.file_prefix_delimiter + f['name']
+        file_name = os.path.join(self.work_dir, f['name'] + '.gz')
+        if not self.is_downloaded(f, file_name):
+            remove_file(file_name)
+            # the stream moves file_name into place only when the download is complete
+            self.mark_downloaded(f, file_name)
+
+        def opener(mode):
+            if next_file is not None:
+                next_file['prefetch']()
+            return open_stream(url, file_name, mode)
+
+        f['path'] = file_name
+        f['open'] = opener
+        f['prefetch'] = lambda: start_stream(url, file_name)
+
+
+    def is_downloaded(self, f, file_name):
+        """ returns True if file_name is a complete download of the listed version of f """
+        if not os.path.exists(file_name):
+            return False
+        if not REDOWNLOAD:
+            return True
+        try:
+            with io.open(file_name + DONE_SUFFIX, 'rt') as fd:
+                marker = json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return False
+        return marker['modified'] == f['modified'].isoformat() and marker['size'] == f['size'] \
+            and marker.get('local_size', os.path.getsize(file_name)) == os.path.getsize(file_name)
+
+    @staticmethod
+    def mark_downloaded(f, file_name, local_size=None):
+        marker = {'modified': f['modified'].isoformat(), 'size': f['size']}
+        if local_size is not None:
+            marker['local_size'] = local_size
+        with io.open(file_name + DONE_SUFFIX, 'wt') as fd:
+            json.dump(marker, fd)
+
+
+def remove_file(file_name):
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+
+class FileListParser(HTMLParser):
+    """ collects links of a directory listing with the text preceding each of them (date, time, size) """
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+        self.text = ''
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.links.append((dict(attrs).get('href', ''), self.text))
+        self.text = ''
+
+    def handle_endtag(self, tag):
+        self.text = ''
+
+    def handle_data(self, data):
+        self.text += data
+
 
 class StandardDbLoader(AbstractDbLoader):
+    pipelined = PIPELINED_DOWNLOAD
     series_file = None
     aspect_files = []
     data_files = []
@@ -180,8 +296,15 @@ class StandardDbLoader(AbstractDbLoader):
         not_dicts = [self.series_file] + self.aspect_files + self.data_files + self.txt_files
         self.dict_files = [f for f in files if f != self.series_file and f not in not_dicts]
 
-        for f in files:
-            self.download_file(f, True)
+        if self.pipelined:
+            # in the order of parsing: meta, series, data, aspect
+            files = self.dict_files + self.txt_files + [self.series_file] \
+                + sorted(self.data_files, key=cmp_to_key(file_cmp)) + sorted(self.aspect_files, key=cmp_to_key(file_cmp))
+            for f, next_file in zip(files, files[1:] + [None]):
+                self.stream_file(f, next_file)
+        else:
+            for f in files:
+                self.download_file(f, True)
 
     @staticmethod
     def read_txt(f):
@@ -251,6 +374,9 @@ class StandardDbLoader(AbstractDbLoader):
         return result
 
     def approx_data_count(self):
+        if self.pipelined:
+            # estimate from the listing, counting lines would wait for the whole download
+            return max(1, sum(f['size'] for f in self.data_files) // APPROX_DATA_LINE_BYTES)
         counter = -1
         for f in self.data_files:
             with f['open']('rt') as fd:
@@ -259,6 +385,8 @@ class StandardDbLoader(AbstractDbLoader):
         return max(1, counter)
 
     def approx_series_count(self):
+        if self.pipelined:
+            return max(1, self.series_file['size'] // APPROX_SERIES_LINE_BYTES)
         counter = -1
         with self.series_file['open']('rt') as f:
             while len(f.readline()) > 0:
@@ -294,107 +422,72 @@ class StandardDbLoader(AbstractDbLoader):
         log(self.db_id + ": last series: " + str(last))
 
     def parse_data(self):
-        data_files = sorted(self.data_files, key=cmp_to_key(file_cmp))
-        for f in data_files:
-            with f['open']('rt') as fd:
-                log(self.db_id + ": parse " + f['name'])
-                header = fd.readline()
-                header = header.strip()
-                header = header.split('\t')
-                header = [h.strip() for h in header]
-                last = None
-                while True:
-                    line = fd.readline()
-                    if len(line) == 0:
-                        break
-                    if len(line.strip()) == 0:
-                        continue
-                    # log(line)
-                    line = line.split('\t')
-                    line = [l.strip() for l in line]
-                    line = dict(zip(header, line))
-                    # log(line, header)
-                    year = int(line['year'])
-                    period = line['period']
-                    footnote_codes = line.get('footnote_codes', '')
-                    if len(footnote_codes) == 0:
-                        footnote_codes = []
-                        if line.get('cont_break') == 'Y':
-                            footnote_codes.append('B')
-                        if line.get('status') == 'P':
-                            footnote_codes.append('P')
-                        if line.get('footnote_exists') == 'Y':
-                            footnote_codes.append('F')
-                    else:
-                        footnote_codes = footnote_codes.split(',')
-                    value = line['value'].replace("$", "")
-                    if value == '-' or value == '':
-                        value = float('nan')
-                    else:
-                        value = float(value)
-
-                    record = {
-                        'series_id':line['series_id'],
-                        'year': year,
-                        'period': period,
-                        'footnote_codes': footnote_codes,
-                        'value': value
-                    }
-                    yield record
-                    last = {'line':line, 'record':record}
-                log(self.db_id + ": last record:" + str(last))
+        return self.parse_records(self.data_files, False)
 
     def parse_aspect(self):
-        aspect_files = sorted(self.aspect_files, key=cmp_to_key(file_cmp))
-        for f in aspect_files:
-            with f['open']('rt') as fd:
-                log(self.db_id + ": parse " + f['name'])
-                header = fd.readline()
-                header = header.strip()
-                header = header.split('\t')
-                header = [h.strip() for h in header]
-                while True:
-                    line = fd.readline()
-                    if len(line) == 0:
-                        break
-                    if len(line.strip()) == 0:
-                        continue
-                    # log(line)
-                    line = line.split('\t')
-                    line = [l.strip() for l in line]
-                    line = dict(zip(header, line))
-                    # log(line, header)
-                    year = int(line['year'])
-                    period = line['period']
-                    aspect_type = line['aspect_type']
-                    footnote_codes = line.get('footnote_codes', '')
-                    if len(footnote_codes) == 0:
-                        footnote_codes = []
-                        if line.get('cont_break') == 'Y':
-                            footnote_codes.append('B')
-                        if line.get('status') == 'P':
-                            footnote_codes.append('P')
-                        if line.get('footnote_exists') == 'Y':
-                            footnote_codes.append('F')
-                    else:
-                        footnote_codes = footnote_codes.split(',')
-                    value = line['value'].replace("$", "")
-                    if value == '-' or value == '':
-                        value = float('nan')
-                    else:
-                        value = float(value)
-
-                    record = {
-                        'series_id':line['series_id'],
-                        'year': year,
-                        'period': period,
-                        'aspect_type': aspect_type,
-                        'value': value,
-                        'footnote_codes': footnote_codes,
-                    }
-                    yield record
-                    last = {'line':line, 'record':record}
+        return self.parse_records(self.aspect_files, True)
+
+    def parse_records(self, files, aspect):
+        """ generator, returns record tuples (see records.py) of data or aspect files """
+        files = sorted(files, key=cmp_to_key(file_cmp))
+        if PARSE_WORKERS > 1 and sum(f.get('size', 0) for f in files) >= PARSE_PARALLEL_MIN_BYTES:
+            for record in self.parse_files_parallel(files, aspect):
+                yield record
+            return
+        for f in files:
+            log(self.db_id + ": parse " + f['name'])
+            last = None
+            for record in self.parse_file(f, aspect):
+                yield record
+                last = record
+            log(self.db_id + ": last record:" + str(last))
+
+    @staticmethod
+    def parse_file(f, aspect):
+        with f['open']('rt') as fd:
+            header = parse_header(fd.readline())
+            while True:
+                line = fd.readline()
+                if len(line) == 0:
+                    break
+                if len(line.strip()) == 0:
+                    continue
+                yield parse_record(header, line, aspect)
+
+    def parse_files_parallel(self, files, aspect):
+        """ splits files into line aligned chunks and parses them in a process pool, keeps the line order.
+
+        Chunks of the next file are submitted while the previous one is still parsed, so many small files
+        are parsed in parallel as well. The pool (get_parse_pool) is shared by the data and aspect passes.
+        """
+        executor = self.get_parse_pool()
+        pending = deque()
+        last = None
+
+        def results():
+            """ generator, returns records of the oldest pending chunk, None marks the end of a file """
+            nonlocal last
+            future = pending.popleft()
+            if future is None:
                 log(self.db_id + ": last record:" + str(last))
+                return
+            for record in future.result():
+                yield record
+                last = record
+
+        for f in files:
+            log(self.db_id + ": parse " + f['name'])
+            with f['open']('rb') as fd:
+                header = parse_header(decode_str(fd.readline()))
+                for chunk in read_chunks(fd, PARSE_CHUNK_BYTES):
+                    pending.append(executor.submit(parse_chunk, header, chunk, aspect))
+                    while len(pending) > PARSE_WORKERS * 2:
+                        for record in results():
+                            yield record
+            pending.append(None)
+        while len(pending) > 0:
+            for record in results():
+                yield record
 
 
 def file_cmp(f1, f2):
@@ -420,12 +513,35 @@ def file_cmp(f1, f2):
 
 
 class ZipDbLoader(StandardDbLoader):
+    """ loader of dbs published as series.zip, data.zip and meta.zip.
+
+    Every archive is opened once and its members are read through the shared ZipFile, counts are estimated
+    from the sizes in the central directory, so each member is inflated once by parsing.
+    """
+    pipelined = False
 
     def __init__(self, db_id):
         super().__init__(db_id)
         self.file_prefix_delimiter = '_'
+        self.archives = []
+
+    def clear(self):
+        self.close_archives()
+        super().clear()
+
+    def close_archives(self):
+        for z in self.archives:
+            z.close()
+        self.archives = []
+
+    def approx_data_count(self):
+        return max(1, sum(sampled_line_count(f) for f in self.data_files))
+
+    def approx_series_count(self):
+        return max(1, sampled_line_count(self.series_file))
 
     def download(self):
+        self.close_archives()
         os.makedirs(self.work_dir, exist_ok=True)
 
         zip_files = self.load_file_list()
@@ -442,26 +558,37 @@ class ZipDbLoader(StandardDbLoader):
         self.dict_files = self.convert_zip_to_files(meta_zip_file)
 
     def convert_zip_to_files(self, zf):
+        z = zipfile.ZipFile(zf['path'], 'r')
+        self.archives.append(z)
         res = []
-        with zipfile.ZipFile(zf['open']('rb'), 'r') as z:
-            for i in z.infolist():
-
-                def mk_opener(f, name):
-                    def opener(mode):
-                        z = zipfile.ZipFile(f['open']('rb'), 'r')
-                        r = z.open(name, mode[0])
-                        if 'b' not in mode:
-                            r = io.TextIOWrapper(r)
-                        return r
-                    return opener
-
-                res.append({
-                    'name': i.filename[len(self.db_id) + len(self.file_prefix_delimiter):],
-                    'open': mk_opener(zf, i.filename)
-                })
+        for i in z.infolist():
+
+            def mk_opener(name):
+                def opener(mode):
+                    r = z.open(name, 'r')
+                    if 'b' not in mode:
+                        r = io.TextIOWrapper(r)
+                    return r
+                return opener
+
+            res.append({
+                'name': i.filename[len(self.db_id) + len(self.file_prefix_delimiter):],
+                'size': i.file_size,
+                'open': mk_opener(i.filename)
+            })
         return res
 
 
+def sampled_line_count(f):
+    """ returns line count of file (without header) estimated from its size and the first LINE_SAMPLE_BYTES """
+    with f['open']('rb') as fd:
+        sample = fd.read(LINE_SAMPLE_BYTES)
+    lines = sample.count(b'\n')
+    if len(sample) < LINE_SAMPLE_BYTES:
+        return max(0, lines - 1)
+    return f['size'] * lines // len(sample)
+
+
 loaders = [
     StandardDbLoader("AP"),
     StandardDbLoader("BD"),
@@ -536,6 +663,8 @@ loaders = [
     # "PI" - missed
 ]
 
+loaders_by_id = dict((l.db_id, l) for l in loaders)
+
 
 if __name__ == "__main__":
     # log(load_db_list())
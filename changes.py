@@ -0,0 +1,181 @@
+import datetime
+import gzip
+import json
+import math
+import os
+import zipfile
+
+from config import DATA_PREFIX, ZIP_SUFFIX, JSON_SUFFIX, CHANGES_FILE_NAME, CHANGES_HISTORY, \
+    CHANGES_MAX_OBSERVATIONS
+from storage import write_gzip
+
+
+def series_crcs(db_path):
+    """ returns dict series_id -> (crc of data member, zip path) of all data shards of db """
+    result = dict()
+    if not os.path.isdir(db_path):
+        return result
+    for fn in os.listdir(db_path):
+        if fn.startswith(DATA_PREFIX) and fn.endswith(ZIP_SUFFIX):
+            path = os.path.join(db_path, fn)
+            with zipfile.ZipFile(path, 'r') as z:
+                for i in z.infolist():
+                    result[i.filename[:-len(JSON_SUFFIX)]] = (i.CRC, path)
+    return result
+
+
+def read_member(zips, path, series_id):
+    z = zips.get(path)
+    if z is None:
+        z = zips[path] = zipfile.ZipFile(path, 'r')
+    return json.loads(z.read(series_id + JSON_SUFFIX).decode())
+
+
+def same_value(a, b):
+    return a == b or isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b)
+
+
+def same_observation(a, b):
+    return a.keys() == b.keys() and all(same_value(a[k], b[k]) for k in a.keys())
+
+
+def changed_observations(old, new):
+    """ returns observations of new which are absent in old or differ from it
+    and [year, period] of observations of old which are absent in new """
+    old = dict(((o['year'], o['period']), o) for o in old)
+    keys = set((o['year'], o['period']) for o in new)
+    changed = [o for o in new if (o['year'], o['period']) not in old
+               or not same_observation(old[(o['year'], o['period'])], o)]
+    removed = [list(k) for k in sorted(old.keys()) if k not in keys]
+    return changed, removed
+
+
+def diff_generations(old_path, new_path):
+    """ returns added, removed and changed series of new db dir against old one and the changed observations.
+
+    Without old_path all series of new db dir are added and no observations are recorded, clients of the first
+    generation load the whole db anyway. Series whose data members have different CRCs are decoded and compared
+    by observations, so a change of the json encoding alone changes no series. Observations are recorded only
+    if there are no more than CHANGES_MAX_OBSERVATIONS of them.
+    """
+    new = series_crcs(new_path)
+    if old_path is None:
+        return {
+            'added': sorted(new.keys()),
+            'removed': [],
+            'changed': [],
+            'observations': None,
+            'removed_observations': None,
+        }
+    old = series_crcs(old_path)
+    added = sorted(s for s in new if s not in old)
+    removed = sorted(s for s in old if s not in new)
+    changed = []
+    observations = dict()
+    removed_observations = dict()
+    count = 0
+    zips = dict()
+    try:
+        for s in sorted(s for s in new if s in old and new[s][0] != old[s][0]):
+            obs, removed_obs = changed_observations(read_member(zips, old[s][1], s), read_member(zips, new[s][1], s))
+            if len(obs) == 0 and len(removed_obs) == 0:
+                continue
+            changed.append(s)
+            count += len(obs) + len(removed_obs)
+            if count <= CHANGES_MAX_OBSERVATIONS:
+                observations[s] = obs
+                removed_observations[s] = removed_obs
+        for s in added:
+            if count > CHANGES_MAX_OBSERVATIONS:
+                break
+            observations[s] = read_member(zips, new[s][1], s)
+            count += len(observations[s])
+    finally:
+        for z in zips.values():
+            z.close()
+    if count > CHANGES_MAX_OBSERVATIONS:
+        observations = None
+        removed_observations = None
+    return {
+        'added': added,
+        'removed': removed,
+        'changed': changed,
+        'observations': observations,
+        'removed_observations': removed_observations,
+    }
+
+
+def read_changes(db_path):
+    """ returns history of changes of db, newest first """
+    try:
+        with gzip.open(os.path.join(db_path, CHANGES_FILE_NAME), 'rt') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return []
+
+
+def write_changes(old_path, new_path, previous, generation):
+    """ writes history of changes to the new db dir, the history of the old one is extended by the new diff;
+    the first generation (previous is 0) adds all series """
+    history = read_changes(old_path) if previous > 0 else []
+    diff = diff_generations(old_path if previous > 0 else None, new_path)
+    diff['generation'] = generation
+    diff['previous'] = previous
+    diff['created'] = datetime.datetime.now().isoformat()
+    history = [diff] + history
+    write_gzip(os.path.join(new_path, CHANGES_FILE_NAME), json.dumps(history[:CHANGES_HISTORY]))
+
+
+def merge_changes(history, since, generation, with_observations):
+    """ returns changes of series after generation `since` up to `generation`,
+    None if the history does not reach `since` """
+    history = [h for h in history if h['generation'] > since]
+    history.sort(key=lambda h: h['generation'])
+    if since < generation and (len(history) == 0 or history[0]['previous'] > since):
+        return None
+    state = dict()
+    observations = dict() if with_observations else None
+    for h in history:
+        for s in h['added']:
+            state[s] = 'changed' if state.get(s) == 'removed' else 'added'
+        for s in h['changed']:
+            state[s] = 'added' if state.get(s) == 'added' else 'changed'
+        for s in h['removed']:
+            if state.get(s) == 'added':
+                del state[s]
+            else:
+                state[s] = 'removed'
+        if observations is not None:
+            if h['observations'] is None:
+                observations = None
+                continue
+            for s in h['added']:
+                observations.pop(s, None)
+            for s, obs in h['observations'].items():
+                merged = observations.get(s, dict())
+                for o in obs:
+                    merged[(o['year'], o['period'])] = o
+                observations[s] = merged
+            # histories written before removed observations were recorded have no such key
+            for s, keys in (h.get('removed_observations') or dict()).items():
+                merged = observations.get(s, dict())
+                for k in keys:
+                    merged[tuple(k)] = None
+                observations[s] = merged
+    result = {
+        'added': sorted(s for s, v in state.items() if v == 'added'),
+        'removed': sorted(s for s, v in state.items() if v == 'removed'),
+        'changed': sorted(s for s, v in state.items() if v == 'changed'),
+    }
+    if with_observations:
+        if observations is None:
+            result['observations'] = None
+            result['removed_observations'] = None
+        else:
+            present = [s for s in sorted(observations.keys()) if s in state and state[s] != 'removed']
+            result['observations'] = dict(
+                (s, [o for k, o in sorted(observations[s].items()) if o is not None]) for s in present)
+            result['removed_observations'] = dict(
+                (s, [list(k) for k, o in sorted(observations[s].items()) if o is None]) for s in present
+                if state[s] == 'changed' and any(o is None for o in observations[s].values()))
+    return result
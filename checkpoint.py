@@ -0,0 +1,80 @@
+""" completion markers of the stages of a db build.
+
+The markers are kept in CHECKPOINT_FILE_NAME in the tmp dir of the build together with the source listing
+and generation the build belongs to. A completed stage records the sizes of its output files; on load the
+first stage with a missing or resized file is dropped with all stages completed after it.
+"""
+import json
+import os
+
+from config import CHECKPOINT_FILE_NAME
+
+
+def file_sizes(dir_path, names):
+    return dict((n, os.path.getsize(os.path.join(dir_path, n))) for n in names)
+
+
+def intact(dir_path, sizes):
+    """ returns True if all files exist and have the recorded sizes """
+    for n, size in sizes.items():
+        try:
+            if os.path.getsize(os.path.join(dir_path, n)) != size:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+class Checkpoint:
+
+    def __init__(self, dir_path, source):
+        self.dir_path = dir_path
+        self.source = source
+        self.stages = []
+
+    def load(self):
+        """ reads completed stages, returns False if there is no checkpoint of the same source """
+        try:
+            with open(os.path.join(self.dir_path, CHECKPOINT_FILE_NAME), 'rt') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if state['source'] != self.source:
+            return False
+        self.stages = []
+        for s in state['stages']:
+            if not intact(self.dir_path, s['files']):
+                break
+            self.stages.append(s)
+        return True
+
+    def save(self):
+        fn = os.path.join(self.dir_path, CHECKPOINT_FILE_NAME)
+        with open(fn + '.tmp', 'wt') as f:
+            json.dump({'source': self.source, 'stages': self.stages}, f)
+        os.replace(fn + '.tmp', fn)
+
+    def remove(self):
+        try:
+            os.remove(os.path.join(self.dir_path, CHECKPOINT_FILE_NAME))
+        except FileNotFoundError:
+            pass
+
+    def done(self, name):
+        return any(s['name'] == name for s in self.stages)
+
+    def get(self, name):
+        """ returns data of a completed stage """
+        return next(s['data'] for s in self.stages if s['name'] == name)
+
+    def complete(self, name, files=(), data=None):
+        """ marks stage as completed, files are its outputs in the build dir """
+        self.stages.append({'name': name, 'files': file_sizes(self.dir_path, files), 'data': data})
+        self.save()
+
+    def release(self, files):
+        """ forgets intermediate files before they are removed by a later stage """
+        for s in self.stages:
+            for n in files:
+                s['files'].pop(n, None)
+        self.save()
@@ -0,0 +1,288 @@
+""" Python client for the blsgov-datasource http api.
+
+    client = Client('http://localhost:8000', cache_dir='~/.cache/blsgov')
+    for s in client.iter_series('CU'):
+        ...
+    data = client.get_data_many('CU', ['CUUR0000SA0', 'CUSR0000SA0'])
+
+The client keeps a pool of keep-alive connections, fetches batches with a bounded thread pool,
+follows `next_page` links and keeps responses in an on-disk cache. Cached responses are reused
+without a request while the generation of their database is unchanged, otherwise they are
+revalidated with If-None-Match.
+
+Use `Client(app=server.app)` to run against the flask app in-process.
+"""
+import gzip
+import hashlib
+import http.client
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_TIMEOUT = 60
+DEFAULT_GENERATION_TTL = 60
+BATCH_SIZE = 100
+
+GENERATION_HEADER = 'X-Data-Generation'
+
+HEADERS = {
+    "Accept-Encoding": "gzip",
+    "User-Agent": "blsgov-datasource client"
+}
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, path):
+        super().__init__(str(status) + " " + path)
+        self.status = status
+        self.path = path
+
+
+class HttpTransport:
+    """ http transport with a bounded pool of keep-alive connections """
+
+    def __init__(self, base_url, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        url = urllib.parse.urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(pool_size)
+        for i in range(pool_size):
+            self.pool.put(None)
+
+    def request(self, path, headers):
+        conn = self.pool.get()
+        try:
+            if conn is None:
+                conn = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                conn.request('GET', self.base_path + path, headers={**HEADERS, **headers})
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed a keep-alive connection, retry once with a fresh one
+                conn.close()
+                conn = self.connection_class(self.netloc, timeout=self.timeout)
+                conn.request('GET', self.base_path + path, headers={**HEADERS, **headers})
+                response = conn.getresponse()
+                body = response.read()
+            if response.getheader('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return response.status, dict(response.getheaders()), body
+        except Exception:
+            if conn is not None:
+                conn.close()
+            conn = None
+            raise
+        finally:
+            self.pool.put(conn)
+
+    def close(self):
+        while not self.pool.empty():
+            conn = self.pool.get_nowait()
+            if conn is not None:
+                conn.close()
+
+
+class FlaskTransport:
+    """ in-process transport over the flask test client """
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, path, headers):
+        with self.app.test_client() as c:
+            response = c.get(path, headers=headers)
+            return response.status_code, dict(response.headers), response.get_data()
+
+    def close(self):
+        pass
+
+
+class DiskCache:
+    """ stores response bodies with their etag and data generation """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key_path(self, path):
+        key = hashlib.sha1(path.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, path):
+        fn = self.key_path(path)
+        try:
+            with open(fn + '.json', 'rt') as f:
+                entry = json.load(f)
+            with open(fn + '.body', 'rb') as f:
+                entry['body'] = f.read()
+            return entry
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, path, etag, generation, body):
+        fn = self.key_path(path)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp_suffix = '.tmp' + str(threading.get_ident())
+        with open(fn + '.body' + tmp_suffix, 'wb') as f:
+            f.write(body)
+        os.replace(fn + '.body' + tmp_suffix, fn + '.body')
+        with open(fn + '.json' + tmp_suffix, 'wt') as f:
+            json.dump({'path': path, 'etag': etag, 'generation': generation}, f)
+        os.replace(fn + '.json' + tmp_suffix, fn + '.json')
+
+
+class Client:
+
+    def __init__(self, base_url=None, app=None, cache_dir=None, pool_size=DEFAULT_POOL_SIZE,
+                 max_workers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT, generation_ttl=DEFAULT_GENERATION_TTL):
+        if app is not None:
+            self.transport = FlaskTransport(app)
+        elif base_url is not None:
+            self.transport = HttpTransport(base_url, pool_size, timeout)
+        else:
+            raise ValueError("base_url or app is required")
+        self.cache = DiskCache(cache_dir) if cache_dir is not None else None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.generation_ttl = generation_ttl
+        self.generations = dict()
+        self.generations_time = None
+        self.generations_lock = threading.Lock()
+
+    def close(self):
+        self.executor.shutdown()
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_generation(self, db_id):
+        """ returns the current generation of db, refreshed from the db list every generation_ttl seconds """
+        with self.generations_lock:
+            if self.generations_time is None or time.time() - self.generations_time > self.generation_ttl:
+                status, headers, body = self.transport.request('/api/db/', {})
+                if status != 200:
+                    raise ApiError(status, '/api/db/')
+                self.generations = dict((d['id'], d.get('generation')) for d in json.loads(body.decode()))
+                self.generations_time = time.time()
+            return self.generations.get(db_id)
+
+    def get(self, path, db_id=None):
+        """ returns decoded json of path, uses the cache for db scoped paths """
+        cached = self.cache.get(path) if self.cache is not None and db_id is not None else None
+        headers = {}
+        if cached is not None:
+            generation = self.get_generation(db_id)
+            if generation is not None and cached['generation'] == generation:
+                return json.loads(cached['body'].decode())
+            if cached['etag'] is not None:
+                headers['If-None-Match'] = '"' + cached['etag'] + '"'
+
+        status, response_headers, body = self.transport.request(path, headers)
+        if status == 304 and cached is not None:
+            body = cached['body']
+            generation = response_headers.get(GENERATION_HEADER)
+            self.cache.put(path, cached['etag'], None if generation is None else int(generation), body)
+        elif status == 200:
+            etag = response_headers.get('ETag')
+            generation = response_headers.get(GENERATION_HEADER)
+            if self.cache is not None and db_id is not None and etag is not None:
+                self.cache.put(path, etag.strip('"'), None if generation is None else int(generation), body)
+        else:
+            raise ApiError(status, path)
+        return json.loads(body.decode())
+
+    def list_dbs(self):
+        return self.get('/api/db/')
+
+    def get_db(self, db_id):
+        return self.get('/api/db/' + quote(db_id))
+
+    def get_meta(self, db_id):
+        return self.get('/api/db/' + quote(db_id) + '/meta', db_id)
+
+    def get_series(self, db_id, series_id):
+        return self.get('/api/db/' + quote(db_id) + '/series/' + quote(series_id), db_id)
+
+    def iter_series(self, db_id):
+        """ generator, follows next_page links over the whole series list """
+        path = '/api/db/' + quote(db_id) + '/series/'
+        page = ''
+        while page is not None:
+            r = self.get(path + page, db_id)
+            if isinstance(r, list):
+                break
+            for s in r['data']:
+                yield s
+            page = r['next_page']
+
+    def get_data(self, db_id, series_id, kind='data', transform=None, window=None):
+        args = dict((k, v) for k, v in [('transform', transform), ('window', window)] if v is not None)
+        return self.get('/api/db/' + quote(db_id) + '/series/' + quote(series_id) + '/' + kind
+                        + ('?' + urllib.parse.urlencode(args) if args else ''), db_id)
+
+    def get_latest(self, db_id, series_ids=None, **facets):
+        """ returns last observations of series_ids or of series matching facets, e.g. seasonal='S' """
+        args = dict((k, v if isinstance(v, str) else ','.join(v)) for k, v in facets.items())
+        if series_ids is not None:
+            args['series'] = ','.join(series_ids)
+        return self.get('/api/db/' + quote(db_id) + '/latest' + ('?' + urllib.parse.urlencode(args) if args else ''),
+                        db_id)
+
+    def get_changes(self, db_id, since, observations=False):
+        """ returns series added, removed and changed after generation `since` """
+        return self.get('/api/db/' + quote(db_id) + '/changes?since=' + str(since)
+                        + ('&observations=true' if observations else ''), db_id)
+
+    def get_series_many(self, db_id, series_ids):
+        """ returns dict series_id -> series, None for missing series """
+        return self.map_many(lambda sid: self.get_series(db_id, sid), series_ids)
+
+    def get_data_many(self, db_id, series_ids, kind='data', transform=None, window=None):
+        """ returns dict series_id -> data, None for missing series """
+        return self.map_many(lambda sid: self.get_data(db_id, sid, kind, transform, window), series_ids)
+
+    def get_series_batch(self, series_ids, data=False):
+        """ returns dict series_id -> series of any db with its 'db', None for missing series;
+        ids are resolved by /api/series in batches of BATCH_SIZE, an id found in several dbs gives the series
+        of the first db in the response, use /api/series for all of them """
+        series_ids = list(series_ids)
+        batches = [series_ids[i:i + BATCH_SIZE] for i in range(0, len(series_ids), BATCH_SIZE)]
+        result = dict((sid, None) for sid in series_ids)
+        for r in self.executor.map(lambda b: self.get('/api/series?ids=' + ','.join(quote(i) for i in b)
+                                                      + ('&data=true' if data else '')), batches):
+            for db_id, db in r['dbs'].items():
+                for s in db['series']:
+                    if result[s['id']] is None:
+                        result[s['id']] = dict(s, db=db_id)
+        return result
+
+    def map_many(self, fn, series_ids):
+        def call(sid):
+            try:
+                return fn(sid)
+            except ApiError as e:
+                if e.status == 404:
+                    return None
+                raise
+        series_ids = list(series_ids)
+        return dict(zip(series_ids, self.executor.map(call, series_ids)))
+
+
+def quote(s):
+    return urllib.parse.quote(s, safe='')
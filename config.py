@@ -10,21 +10,46 @@ MODIFIED_LESS_THAN = datetime.timedelta(days=365 * 2)
 
 logging.basicConfig(level=logging.INFO)
 
-ERROR_DELAY = 10
+ERROR_DELAY = 10  # base delay of the retry backoff
+RETRY_MAX_DELAY = 5 * 60
+RETRY_MAX_ATTEMPTS = 12
+RETRY_DEADLINE = 60 * 60
 
-DEBUG = os.getenv("DEBUG", 'true').lower() == 'true'
+RATE_LIMIT = 5  # requests per second, shared by all download threads
+RATE_BURST = 10
+RATE_MIN = 0.2
+
+# parse files while they are downloaded, the download cache is written in background
+PIPELINED_DOWNLOAD = os.getenv("PIPELINED_DOWNLOAD", 'false').lower() == 'true'
+STREAM_CHUNK_SIZE = 256 * 1024
+APPROX_SERIES_LINE_BYTES = 200
+APPROX_DATA_LINE_BYTES = 40
+LINE_SAMPLE_BYTES = 1024 * 1024  # line counts of zipped files are estimated from a sample
+
+DISCOVERY_WORKERS = 8
+FILE_LIST_TTL = 15 * 60
+
+DEBUG = os.getenv("DEBUG", 'false').lower() == 'true'
 
 WORK_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "work")
 WRK_DB_DIR = os.path.join(WORK_DIR, 'dbs')
 DB_LIST_FILE_NAME = os.path.join(WRK_DB_DIR, 'list.json.gz')
+ROUTING_FILE_NAME = os.path.join(WRK_DB_DIR, 'routing.json.gz')
 
 META_FILE_NAME = 'meta.json.gz'
+GENERATION_FILE_NAME = 'generation'
+SEARCH_FILE_NAME = 'search.json.gz'
+CHANGES_FILE_NAME = 'changes.json.gz'
+LATEST_FILE_NAME = 'latest.json.gz'
+CHECKPOINT_FILE_NAME = 'checkpoint.json'
+MANIFEST_FILE_NAME = 'manifest.json'
 
 TMP_DB_DIR = os.path.join(WORK_DIR, 'tmp', 'dbs')
 
 SERIES_PREFIX = "series."
 DATA_PREFIX = "data."
 ASPECT_PREFIX = "aspect."
+INDEX_PREFIX = "index."
 
 JSON_SUFFIX='.json'
 JSON_GZ_SUFFIX='.json.gz'
@@ -33,10 +58,54 @@ FILE_NAME_DELIMITER='.'
 
 LOCK_FILE = os.path.join(WORK_DIR, 'lock')
 
+# update.py publishes finished generations to SNAPSHOT_DIR, replicas sync from SNAPSHOT_ORIGIN (a dir or http url)
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR')
+SNAPSHOT_ORIGIN = os.getenv('SNAPSHOT_ORIGIN')
+SNAPSHOT_KEEP = 3
+SNAPSHOT_GRACE_PERIOD = 24 * 60 * 60  # older manifests outlive their successor so running syncs can finish
+SNAPSHOT_RETRY_ATTEMPTS = 3  # per file, a missing file (404) is not retried
+SNAPSHOT_RETRY_DEADLINE = 60
+
+# update daemon: dbs are polled every DAEMON_MIN_INTERVAL within DAEMON_RELEASE_WINDOW of their expected release
+DAEMON_SCHEDULE_FILE = os.path.join(WORK_DIR, 'schedule.json')
+DAEMON_MIN_INTERVAL = 5 * 60
+DAEMON_MAX_INTERVAL = 6 * 60 * 60
+DAEMON_RELEASE_WINDOW = 2 * 24 * 60 * 60
+DAEMON_DEFAULT_PERIOD = 30 * 24 * 60 * 60
+DAEMON_HISTORY = 12
+DAEMON_CATALOG_INTERVAL = 24 * 60 * 60
+
 io.DEFAULT_BUFFER_SIZE = 512 * 1024
 
 MAX_SERIES_PER_BATCH = 25000
 MAX_DATA_PER_BATCH = 1000000
+SERIES_PER_BLOCK = 64
+
+# records are routed to shard files by at most SHARD_WRITERS_MAX_OPEN open gzip writers,
+# lines are buffered in memory up to SHARD_WRITERS_BUFFER_BYTES in total
+SHARD_WRITERS_MAX_OPEN = 32
+SHARD_WRITERS_BUFFER_BYTES = 64 * 1024 * 1024
+
+# data files larger than PARSE_PARALLEL_MIN_BYTES are parsed in chunks by a process pool
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_CHUNK_BYTES = 8 * 1024 * 1024
+PARSE_PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+
+CHANGES_HISTORY = 12
+CHANGES_MAX_OBSERVATIONS = 100000  # per generation, a larger change is recorded without observations
+CHANGES_CACHE_SIZE = 16
+
+LATEST_OBSERVATIONS = 3
+LATEST_CACHE_BYTES = 64 * 1024 * 1024  # per server process, counted as json text
+ANNUAL_PERIODS = ('M13', 'Q05', 'S03', 'A01')
+
+TRANSFORM_CACHE_SIZE = 1024
+
+SEARCH_CACHE_BYTES = 64 * 1024 * 1024  # per server process, counted as json text, parsed indexes take several times more
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 1000
+
+SERIES_BATCH_MAX = 1000  # ids per request of /api/series
 
 try:
     from config_local import *
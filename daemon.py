@@ -0,0 +1,218 @@
+""" resident update scheduler, replaces the hourly `python update.py -a` loop.
+
+    python daemon.py
+
+Every db is polled at its own interval. The median gap between its past modifications gives the expected
+date of the next release, the db is polled every DAEMON_MIN_INTERVAL within DAEMON_RELEASE_WINDOW of it
+and once before the window opens. Overdue dbs back off exponentially up to DAEMON_MAX_INTERVAL.
+Modified dbs are queued by size and rebuilt one at a time by an update thread, so polling goes on
+during long builds. The db catalog (overview.txt and surveys) is reloaded every DAEMON_CATALOG_INTERVAL.
+"""
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import statistics
+import threading
+import time
+
+from blsgov_api import load_db_list, get_loader
+from config import DAEMON_SCHEDULE_FILE, DAEMON_MIN_INTERVAL, DAEMON_MAX_INTERVAL, DAEMON_RELEASE_WINDOW, \
+    DAEMON_DEFAULT_PERIOD, DAEMON_HISTORY, DAEMON_CATALOG_INTERVAL
+from http_api import get_stats, RetryError
+from update import read_db_list, update_db, is_recent
+
+logger = logging.getLogger(__name__)
+
+
+def log(*args):
+    s = " ".join([str(i) for i in args])
+    logger.log(logging.INFO, s)
+
+
+def release_period(history):
+    """ returns median time between modifications, history is a sorted list of timestamps """
+    gaps = [b - a for a, b in zip(history, history[1:])]
+    if len(gaps) == 0:
+        return DAEMON_DEFAULT_PERIOD
+    return statistics.median(gaps)
+
+
+def next_interval(history, misses, now):
+    """ returns seconds until the next check of a db """
+    if len(history) == 0:
+        return DAEMON_MIN_INTERVAL
+    expected = history[-1] + release_period(history)
+    if now < expected - DAEMON_RELEASE_WINDOW:
+        interval = expected - DAEMON_RELEASE_WINDOW - now
+    elif now < expected + DAEMON_RELEASE_WINDOW:
+        interval = DAEMON_MIN_INTERVAL
+    else:
+        interval = DAEMON_MIN_INTERVAL * 2 ** min(misses, 16)
+    return max(DAEMON_MIN_INTERVAL, min(DAEMON_MAX_INTERVAL, interval))
+
+
+class Schedule:
+    """ modification history and next check time of dbs, persisted in DAEMON_SCHEDULE_FILE """
+
+    def __init__(self):
+        self.dbs = dict()
+        self.heap = []
+
+    def load(self):
+        try:
+            with open(DAEMON_SCHEDULE_FILE, 'rt') as f:
+                self.dbs = json.load(f)
+        except FileNotFoundError:
+            self.dbs = dict()
+        except ValueError as e:
+            logger.error("schedule is unreadable, start with an empty one: " + str(e))
+            self.dbs = dict()
+        self.heap = [(s['next_check'], db_id) for db_id, s in self.dbs.items()]
+        heapq.heapify(self.heap)
+
+    def save(self):
+        """ replaces the schedule file atomically, its content is on disk before the rename """
+        os.makedirs(os.path.dirname(DAEMON_SCHEDULE_FILE), exist_ok=True)
+        with open(DAEMON_SCHEDULE_FILE + '.tmp', 'wt') as f:
+            json.dump(self.dbs, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(DAEMON_SCHEDULE_FILE + '.tmp', DAEMON_SCHEDULE_FILE)
+
+    def add(self, db_id, modified):
+        """ adds db to the schedule if it is new and records its modification """
+        if db_id not in self.dbs:
+            self.dbs[db_id] = {'history': [], 'misses': 0, 'next_check': 0}
+            heapq.heappush(self.heap, (0, db_id))
+        self.observe(db_id, modified)
+
+    def observe(self, db_id, modified):
+        """ records modification timestamp of db, returns True if it is new """
+        s = self.dbs[db_id]
+        if len(s['history']) > 0 and modified <= s['history'][-1]:
+            return False
+        s['history'] = (s['history'] + [modified])[-DAEMON_HISTORY:]
+        s['misses'] = 0
+        return True
+
+    def reschedule(self, db_id, changed, now):
+        s = self.dbs[db_id]
+        if not changed and now > s['history'][-1] + release_period(s['history']) + DAEMON_RELEASE_WINDOW:
+            s['misses'] += 1
+        s['next_check'] = now + next_interval(s['history'], s['misses'], now)
+        heapq.heappush(self.heap, (s['next_check'], db_id))
+
+    def pop_due(self, now):
+        """ returns id of a db which should be checked now, None if there is none """
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            t, db_id = heapq.heappop(self.heap)
+            if db_id in self.dbs and self.dbs[db_id]['next_check'] == t:
+                return db_id
+        return None
+
+    def next_time(self):
+        return self.heap[0][0] if len(self.heap) > 0 else float('inf')
+
+
+class Daemon:
+
+    def __init__(self):
+        self.schedule = Schedule()
+        self.catalog = dict()
+        self.catalog_time = None
+        self.db_list = []
+        self.built = dict()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.updates = queue.PriorityQueue()
+        self.counter = itertools.count()
+
+    def load_catalog(self):
+        """ loads names and modification dates of all dbs, this also fills the listing caches of the loaders;
+        if the listing is unavailable, the previous catalog is kept and the reload is retried soon """
+        try:
+            dbs = load_db_list()
+        except RetryError as e:
+            logger.error("catalog reload failed, keep the previous catalog: " + str(e))
+            self.catalog_time = time.time() - DAEMON_CATALOG_INTERVAL + DAEMON_MIN_INTERVAL
+            return
+        self.catalog = dict((d['id'], d) for d in dbs)
+        for d in dbs:
+            self.schedule.add(d['id'], datetime.datetime.fromisoformat(d['modified']).timestamp())
+            self.enqueue(d, get_loader(d['id']))
+        self.catalog_time = time.time()
+        self.schedule.save()
+
+    def check(self, db_id):
+        """ lists the db directory, queues an update if the db was modified; returns True if it was.
+        A queued or building db is not listed, its build reads the cached listing of the same loader """
+        with self.lock:
+            if db_id in self.queued:
+                return False
+        loader = get_loader(db_id)
+        modified = loader.get_last_modification(0)
+        changed = self.schedule.observe(db_id, modified.timestamp())
+        self.enqueue(dict(self.catalog[db_id], modified=modified.isoformat()), loader)
+        return changed
+
+    def enqueue(self, ndb, loader):
+        if not is_recent(ndb):
+            return
+        with self.lock:
+            built = self.built.get(ndb['id'])
+            if ndb['id'] in self.queued or built is not None and built >= ndb['modified']:
+                return
+            self.queued.add(ndb['id'])
+        # small dbs first, a release of CU does not wait for a rebuild of SM
+        size = sum(f['size'] for f in loader.load_file_list())
+        log(ndb['id'] + ": queued, modified", ndb['modified'], "size", size)
+        self.updates.put((size, next(self.counter), ndb))
+
+    def update_loop(self):
+        while True:
+            size, n, ndb = self.updates.get()
+            try:
+                log(ndb['id'] + ": update")
+                update_db(ndb, self.db_list)
+            except Exception:
+                logger.exception(ndb['id'] + ": update failed")
+            with self.lock:
+                self.built = dict((d['id'], d['modified']) for d in self.db_list)
+                self.queued.discard(ndb['id'])
+            log('http stats:', get_stats())
+
+    def run(self):
+        self.schedule.load()
+        self.db_list = read_db_list()
+        self.built = dict((d['id'], d['modified']) for d in self.db_list)
+        threading.Thread(target=self.update_loop, daemon=True).start()
+        self.load_catalog()
+        while True:
+            now = time.time()
+            if now - self.catalog_time > DAEMON_CATALOG_INTERVAL:
+                try:
+                    self.load_catalog()
+                except Exception:
+                    logger.exception("catalog reload failed")
+                    self.catalog_time = now
+                continue
+            db_id = self.schedule.pop_due(now)
+            if db_id is None:
+                time.sleep(max(0, min(self.schedule.next_time(), self.catalog_time + DAEMON_CATALOG_INTERVAL) - now))
+                continue
+            changed = False
+            if db_id in self.catalog:
+                try:
+                    changed = self.check(db_id)
+                except Exception:
+                    logger.exception(db_id + ": check failed")
+            self.schedule.reschedule(db_id, changed, now)
+            self.schedule.save()
+
+
+if __name__ == '__main__':
+    Daemon().run()
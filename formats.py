@@ -0,0 +1,98 @@
+""" representations of series and observations served by the api.
+
+    json      array of objects
+    columnar  object of parallel arrays, one per field
+    csv       header line and a line per item, footnote codes are joined by ','
+    binary    observations only, little-endian: header (4s magic, uint32 count) and count records
+              (uint16 year, 3s ascii period, float64 value), a missing value is NaN
+
+A format is selected by the `format` argument or by the Accept header (see MIMETYPES).
+"""
+import csv
+import io
+import json
+import math
+import struct
+
+JSON = 'json'
+COLUMNAR = 'columnar'
+CSV = 'csv'
+BINARY = 'binary'
+
+MIMETYPES = {
+    JSON: 'application/json',
+    COLUMNAR: 'application/vnd.blsgov.columnar+json',
+    CSV: 'text/csv',
+    BINARY: 'application/octet-stream',
+}
+
+BINARY_MAGIC = b'BLS1'
+BINARY_HEADER = struct.Struct('<4sI')
+BINARY_RECORD = struct.Struct('<H3sd')
+
+
+def dumps(obj):
+    """ returns compact json """
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def fields(items):
+    """ returns keys of items in order of their first appearance """
+    keys = dict()
+    for i in items:
+        for k in i.keys():
+            keys[k] = None
+    return list(keys.keys())
+
+
+def to_columnar(items):
+    return dict((k, [i.get(k) for i in items]) for k in fields(items))
+
+
+def csv_value(v):
+    if v is None or isinstance(v, float) and math.isnan(v):
+        return ''
+    if isinstance(v, list):
+        return ','.join(str(i) for i in v)
+    return v
+
+
+def to_csv(items):
+    keys = fields(items)
+    out = io.StringIO()
+    w = csv.writer(out, lineterminator='\n')
+    w.writerow(keys)
+    for i in items:
+        w.writerow([csv_value(i.get(k)) for k in keys])
+    return out.getvalue()
+
+
+def to_binary(observations):
+    buf = bytearray(BINARY_HEADER.size + BINARY_RECORD.size * len(observations))
+    BINARY_HEADER.pack_into(buf, 0, BINARY_MAGIC, len(observations))
+    offset = BINARY_HEADER.size
+    for o in observations:
+        value = math.nan if o['value'] is None else o['value']
+        BINARY_RECORD.pack_into(buf, offset, o['year'], o['period'].encode(), value)
+        offset += BINARY_RECORD.size
+    return bytes(buf)
+
+
+def from_binary(data):
+    """ returns list of (year, period, value) of to_binary output """
+    magic, count = BINARY_HEADER.unpack_from(data, 0)
+    if magic != BINARY_MAGIC:
+        raise ValueError("not a binary observations layout")
+    records = data[BINARY_HEADER.size:BINARY_HEADER.size + BINARY_RECORD.size * count]
+    return [(y, p.decode(), v) for y, p, v in BINARY_RECORD.iter_unpack(records)]
+
+
+def render(items, fmt):
+    """ returns body of list of items in format fmt """
+    if fmt == COLUMNAR:
+        return dumps(to_columnar(items))
+    if fmt == CSV:
+        return to_csv(items)
+    if fmt == BINARY:
+        return to_binary(items)
+    return dumps(items)
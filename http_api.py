@@ -1,4 +1,8 @@
+import os
 import time
+import random
+import threading
+import zlib
 import urllib.request
 import urllib.error
 from socket import timeout
@@ -8,7 +12,8 @@ import logging
 import shutil
 import io
 
-from config import PROXY, ERROR_DELAY, DEBUG
+from config import PROXY, ERROR_DELAY, DEBUG, RETRY_MAX_DELAY, RETRY_MAX_ATTEMPTS, RETRY_DEADLINE, \
+    RATE_LIMIT, RATE_BURST, RATE_MIN, STREAM_CHUNK_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -18,43 +23,163 @@ HEADERS = [
     ("User-Agent", "QuantNet (info@quantnet.ai)")
 ]
 
+THROTTLE_CODES = (429, 503)
+
 def log(*args):
     s = " ".join([str(i) for i in args])
     logger.log(logging.INFO, s)
 
 
-def load_with_retry(url, need_json=False, use_gzip=True):
-    while True:
-        log("request", url)
+class RetryError(Exception):
+    pass
+
+
+class RetryPolicy:
+    """ exponential backoff with full jitter, limited by attempt count and deadline """
+
+    def __init__(self, base_delay=ERROR_DELAY, max_delay=RETRY_MAX_DELAY, max_attempts=RETRY_MAX_ATTEMPTS,
+                 deadline=RETRY_DEADLINE, final_codes=()):
+        """ http errors with a status in final_codes are raised at once """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.final_codes = final_codes
+
+    def delay(self, attempt, min_delay=0):
+        """ returns delay before the next attempt, attempt counts from 1 """
+        d = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(d, min(min_delay, self.max_delay))
+
+    def run(self, url, fn):
+        """ calls fn until it succeeds, returns its result or raises RetryError """
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            rate_limiter.acquire()
+            count('requests')
+            min_delay = 0
+            try:
+                result = fn()
+                rate_limiter.success()
+                return result
+            except (KeyboardInterrupt, RetryError) as e:
+                raise e
+            except urllib.error.HTTPError as err:
+                if err.code in self.final_codes:
+                    count('failures')
+                    raise err
+                if err.code in THROTTLE_CODES:
+                    log("throttled", err.code, url)
+                    count('throttled')
+                    rate_limiter.throttle()
+                    min_delay = retry_after(err)
+                else:
+                    logger.exception("unexpected")
+            except timeout:
+                log("timeout", url)
+            except Exception:
+                logger.exception("unexpected")
+            delay = self.delay(attempt, min_delay)
+            if attempt >= self.max_attempts or time.time() + delay - started > self.deadline:
+                count('failures')
+                raise RetryError("request failed after " + str(attempt) + " attempts: " + url)
+            count('retries')
+            time.sleep(delay)
+
+
+def retry_after(err):
+    try:
+        return float(err.headers.get('Retry-After', 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+class RateLimiter:
+    """ token bucket shared by all threads.
+
+    The rate is halved when the server throttles and recovers step by step on successful requests.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, min_rate=RATE_MIN):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+stats_lock = threading.Lock()
+stats = {
+    'requests': 0,
+    'retries': 0,
+    'throttled': 0,
+    'failures': 0,
+}
+
+
+def count(name):
+    with stats_lock:
+        stats[name] += 1
+
+
+def get_stats():
+    """ returns request counters and the current rate limit """
+    with stats_lock:
+        r = dict(stats)
+    r['rate'] = rate_limiter.rate
+    return r
+
+
+def load_with_retry(url, need_json=False, use_gzip=True, policy=None):
+    log("request", url)
+
+    def load():
         try:
-            if use_gzip == True:
-                opener.addheaders = HEADERS
-            urllib.request.install_opener(opener)
-            response = urllib.request.urlopen(url, timeout=10)
-            body = response.read()
-            if response.headers.get('Content-Encoding') == 'gzip':
-                body = gzip.decompress(body)
-            body = decode_str(body)
-            if need_json:
-                body = json.loads(body)
-            return body
-        except KeyboardInterrupt as e:
-            raise e
+            response = opener.open(make_request(url, use_gzip), timeout=10)
         except urllib.error.HTTPError as err:
             if err.code == 404:
                 return ''
-            else:
-                logger.exception("unexpected")
-                time.sleep(ERROR_DELAY)
-        except timeout:
-            log("timeout")
-            time.sleep(ERROR_DELAY)
-        except Exception:
-            logger.exception("unexpected")
-            time.sleep(ERROR_DELAY)
-        finally:
-            opener.addheaders = []
-            urllib.request.install_opener(None)
+            raise
+        body = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        body = decode_str(body)
+        if need_json:
+            body = json.loads(body)
+        return body
+
+    return (policy or default_policy).run(url, load)
+
+
+def make_request(url, use_gzip):
+    # headers are set per request, the shared opener is used by several threads
+    return urllib.request.Request(url, headers=dict(HEADERS if use_gzip else HEADERS[1:]))
 
 
 def decode_str(body):
@@ -65,28 +190,184 @@ def decode_str(body):
     return body
 
 
-def load_file(url, file_name, use_gzip=True):
-    while True:
+def load_file(url, file_name, use_gzip=True, policy=None):
+    log("load file: " + url + " -> " + file_name)
+
+    def load():
+        with opener.open(make_request(url, use_gzip), timeout=60) as response:
+            with io.open(file_name, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            if response.length:
+                raise urllib.error.ContentTooShortError("incomplete read: " + url, None)
+            encoding = response.headers.get('Content-Encoding')
+        if use_gzip and encoding != 'gzip':
+            tf = file_name + '.tmp'
+            gzip_file(file_name, tf)
+            shutil.move(tf, file_name)
+        log("done")
+
+    (policy or default_policy).run(url, load)
+
+
+class StreamChangedError(RetryError):
+    pass
+
+
+class StreamingDownload:
+    """ download of a remote file to file_name (gzipped) which can be read while it is in progress.
+
+    A background thread downloads and decodes the file and appends the bytes to a plain .part file as well,
+    readers (StreamReader) follow that file, so network and parsing overlap and all readers of a file share
+    one download. If the connection breaks, the file is requested again and the bytes already written are
+    skipped. file_name appears only when the download is complete. Use open_stream or start_stream.
+    """
+
+    def __init__(self, url, file_name, policy=None):
+        self.url = url
+        self.file_name = file_name
+        self.part_name = file_name + '.part'
+        self.policy = policy or default_policy
+        self.cond = threading.Condition()
+        self.produced = 0
+        self.done = False
+        self.error = None
+        self.last_modified = None
+        with open(self.part_name, 'wb'):
+            pass
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        tmp_name = self.file_name + '.tmp'
+        error = None
         try:
-            log("load file: " + url + " -> " + file_name)
-            if use_gzip == True:
-                opener.addheaders = HEADERS
-            urllib.request.install_opener(opener)
-            result = urllib.request.urlretrieve(url, file_name)
-            if use_gzip and result[1].get('Content-Encoding') != 'gzip':
-                tf = file_name + '.tmp'
-                gzip_file(file_name, tf)
-                shutil.move(tf, file_name)
-            log("done")
+            with gzip.open(tmp_name, 'wb') as out, open(self.part_name, 'ab') as part:
+                self.policy.run(self.url, lambda: self.fetch(out, part))
+        except BaseException as e:
+            error = e
+        with streams_lock:
+            try:
+                if error is None:
+                    shutil.move(tmp_name, self.file_name)
+            except OSError as e:
+                error = e
+            if error is not None:
+                remove_file(tmp_name)
+            # open readers keep reading the removed file
+            remove_file(self.part_name)
+            del streams[self.file_name]
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def fetch(self, out, part):
+        log("stream file: " + self.url + " -> " + self.file_name + (" from " + str(self.produced) if self.produced else ""))
+        skip = self.produced
+        with opener.open(make_request(self.url, True), timeout=60) as response:
+            last_modified = response.headers.get('Last-Modified')
+            if self.last_modified is not None and last_modified != self.last_modified:
+                raise StreamChangedError("file changed during download: " + self.url)
+            self.last_modified = last_modified
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+                if response.headers.get('Content-Encoding') == 'gzip' else None
+            while True:
+                chunk = response.read(STREAM_CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                if decoder is not None:
+                    chunk = decoder.decompress(chunk)
+                if skip > 0:
+                    n = min(skip, len(chunk))
+                    chunk = chunk[n:]
+                    skip -= n
+                self.write(out, part, chunk)
+            # read(n) returns b'' on a dropped connection, check that the body is complete
+            if getattr(response, 'length', None) or (decoder is not None and not decoder.eof):
+                raise IOError("incomplete read: " + self.url)
+            if decoder is not None:
+                self.write(out, part, decoder.flush())
+        log("done")
+
+    def write(self, out, part, chunk):
+        if len(chunk) == 0:
             return
-        except KeyboardInterrupt as e:
-            raise e
-        except Exception as e:
-            logger.exception("wget failed")
-            time.sleep(ERROR_DELAY)
-        finally:
-            opener.addheaders = []
-            urllib.request.install_opener(None)
+        out.write(chunk)
+        part.write(chunk)
+        part.flush()
+        with self.cond:
+            self.produced += len(chunk)
+            self.cond.notify_all()
+
+
+class StreamReader(io.RawIOBase):
+    """ reads the .part file of a StreamingDownload up to the bytes written so far, waits for more """
+
+    def __init__(self, download):
+        super().__init__()
+        self.download = download
+        self.fd = open(download.part_name, 'rb')
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        d = self.download
+        with d.cond:
+            while self.position >= d.produced and not d.done:
+                d.cond.wait()
+            if self.position >= d.produced and d.error is not None:
+                raise d.error
+            n = min(len(b), d.produced - self.position)
+        data = self.fd.read(n)
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        self.fd.close()
+        super().close()
+
+
+streams = dict()  # file_name -> StreamingDownload in progress
+streams_lock = threading.Lock()
+
+
+def get_stream(url, file_name, policy=None):
+    """ returns download of file_name in progress, starts it if there is none; None if file_name exists """
+    if os.path.exists(file_name):
+        return None
+    download = streams.get(file_name)
+    if download is None:
+        download = streams[file_name] = StreamingDownload(url, file_name, policy)
+    return download
+
+
+def start_stream(url, file_name, policy=None):
+    """ starts download of file_name in background unless it is downloaded or in progress """
+    with streams_lock:
+        get_stream(url, file_name, policy)
+
+
+def open_stream(url, file_name, mode='rb', policy=None):
+    """ opens remote file for reading while it is downloaded to file_name, see StreamingDownload;
+    a complete file_name is read directly """
+    with streams_lock:
+        download = get_stream(url, file_name, policy)
+        if download is None:
+            return gzip.open(file_name, mode)
+        f = io.BufferedReader(StreamReader(download), STREAM_CHUNK_SIZE)
+    if 'b' not in mode:
+        f = io.TextIOWrapper(f)
+    return f
+
+
+def remove_file(file_name):
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
 
 
 def gzip_file(ifn, ofn):
@@ -113,3 +394,6 @@ proxy_handler = urllib.request.ProxyHandler(PROXIES)
 proxy_auth_handler = urllib.request.ProxyBasicAuthHandler()
 opener = urllib.request.build_opener(proxy_handler, proxy_auth_handler, http_handler, https_handler)
 
+default_policy = RetryPolicy()
+rate_limiter = RateLimiter()
+
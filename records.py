@@ -0,0 +1,211 @@
+""" compact representation of data and aspect records used by the update pipeline.
+
+Loaders yield plain tuples:
+    data:   (series_id, year, period, footnote_codes, value)
+    aspect: (series_id, year, period, footnote_codes, value, aspect_type)
+where footnote_codes is a tuple of codes. Dicts are built only when a series is serialized.
+"""
+import sys
+from array import array
+
+SERIES_ID = 0
+YEAR = 1
+PERIOD = 2
+FOOTNOTES = 3
+VALUE = 4
+ASPECT_TYPE = 5
+
+NO_FOOTNOTES = ()
+
+footnotes_cache = {'': NO_FOOTNOTES}
+
+
+def parse_footnotes(txt):
+    """ returns interned tuple of footnote codes """
+    r = footnotes_cache.get(txt)
+    if r is None:
+        r = footnotes_cache[txt] = tuple(sys.intern(c) for c in txt.split(','))
+    return r
+
+
+def parse_value(txt):
+    value = txt.replace("$", "")
+    if value == '-' or value == '':
+        return float('nan')
+    return float(value)
+
+
+def parse_record(header, line, aspect):
+    """ parses tab separated line of a data or aspect file, header is a dict column name -> position """
+    line = line.split('\t')
+    line = [l.strip() for l in line]
+    if len(line) < len(header):
+        line += [''] * (len(header) - len(line))
+    footnote_codes = line[header['footnote_codes']] if 'footnote_codes' in header else ''
+    if len(footnote_codes) == 0:
+        footnote_codes = []
+        if 'cont_break' in header and line[header['cont_break']] == 'Y':
+            footnote_codes.append('B')
+        if 'status' in header and line[header['status']] == 'P':
+            footnote_codes.append('P')
+        if 'footnote_exists' in header and line[header['footnote_exists']] == 'Y':
+            footnote_codes.append('F')
+        footnote_codes = parse_footnotes(",".join(footnote_codes))
+    else:
+        footnote_codes = parse_footnotes(footnote_codes)
+    record = (
+        line[header['series_id']],
+        int(line[header['year']]),
+        sys.intern(line[header['period']]),
+        footnote_codes,
+        parse_value(line[header['value']]),
+    )
+    if aspect:
+        record += (sys.intern(line[header['aspect_type']]),)
+    return record
+
+
+def parse_chunk(header, chunk, aspect):
+    """ parses line aligned chunk of a data or aspect file, runs in worker processes """
+    try:
+        txt = chunk.decode()
+    except UnicodeDecodeError:
+        txt = chunk.decode("cp1252")
+    return [parse_record(header, line, aspect) for line in txt.split('\n') if len(line.strip()) > 0]
+
+
+def read_chunks(fd, size):
+    """ generator, returns line aligned chunks of binary stream """
+    rest = b''
+    while True:
+        block = fd.read(size)
+        if len(block) == 0:
+            break
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        if end == 0:
+            rest = block
+            continue
+        yield block[:end]
+        rest = block[end:]
+    if len(rest) > 0:
+        yield rest
+
+
+def parse_header(line):
+    header = line.strip().split('\t')
+    return dict((h.strip(), i) for i, h in enumerate(header))
+
+
+class FootnoteTable:
+    """ maps distinct footnote code tuples to small integers """
+
+    def __init__(self, codes=()):
+        self.ids = {NO_FOOTNOTES: 0}
+        self.codes = [NO_FOOTNOTES]
+        for c in codes:
+            self.get_id(tuple(c))
+
+    def get_id(self, codes):
+        i = self.ids.get(codes)
+        if i is None:
+            i = self.ids[codes] = len(self.codes)
+            self.codes.append(codes)
+        return i
+
+
+def format_record(record, footnotes):
+    """ returns tab separated line of a record with footnotes replaced by id, see RecordBatch.add_line """
+    line = record[SERIES_ID] + '\t' + str(record[YEAR]) + '\t' + record[PERIOD] + '\t' \
+           + str(footnotes.get_id(record[FOOTNOTES])) + '\t' + repr(record[VALUE])
+    if len(record) > ASPECT_TYPE:
+        line += '\t' + record[ASPECT_TYPE]
+    return line + '\n'
+
+
+class RecordBatch:
+    """ column store of records of one shard """
+
+    def __init__(self, aspect, footnotes):
+        self.aspect = aspect
+        self.footnotes = footnotes
+        self.series_ids = []
+        self.years = array('H')
+        self.periods = []
+        self.footnote_ids = array('H')
+        self.values = array('d')
+        self.aspect_types = [] if aspect else None
+        self.last_series_id = None
+        self.interned = dict()
+
+    def __len__(self):
+        return len(self.values)
+
+    def intern(self, s):
+        r = self.interned.get(s)
+        if r is None:
+            r = self.interned[s] = s
+        return r
+
+    def add_line(self, line):
+        line = line.rstrip('\n').split('\t')
+        series_id = line[0]
+        if series_id != self.last_series_id:
+            self.last_series_id = self.intern(series_id)
+        self.series_ids.append(self.last_series_id)
+        self.years.append(int(line[1]))
+        self.periods.append(self.intern(line[2]))
+        self.footnote_ids.append(int(line[3]))
+        self.values.append(float(line[4]))
+        if self.aspect:
+            self.aspect_types.append(self.intern(line[5]))
+
+    def sorted_order(self):
+        """ returns record positions sorted by (series_id, year, period), first occurrence of duplicates only """
+        n = len(self)
+        if n == 0:
+            return []
+        series_rank = dict((s, i) for i, s in enumerate(sorted(set(self.series_ids))))
+        period_rank = dict((p, i) for i, p in enumerate(sorted(set(self.periods))))
+        period_bits = len(period_rank).bit_length()
+        index_bits = n.bit_length()
+        # one int per record: series, year, period, position; the position keeps duplicates in input order
+        keys = [((series_rank[self.series_ids[i]] << 16 | self.years[i]) << period_bits | period_rank[self.periods[i]])
+                << index_bits | i for i in range(n)]
+        del series_rank, period_rank
+        keys.sort()
+        mask = (1 << index_bits) - 1
+        order = array('L')
+        last = None
+        for k in keys:
+            key = k >> index_bits
+            if key != last:
+                order.append(k & mask)
+                last = key
+        return order
+
+    def to_dict(self, i):
+        codes = list(self.footnotes.codes[self.footnote_ids[i]])
+        if self.aspect:
+            return {
+                'year': self.years[i],
+                'period': self.periods[i],
+                'aspect_type': self.aspect_types[i],
+                'value': self.values[i],
+                'footnote_codes': codes,
+            }
+        return {
+            'year': self.years[i],
+            'period': self.periods[i],
+            'footnote_codes': codes,
+            'value': self.values[i],
+        }
+
+    def sorted_series(self):
+        """ generator, returns (series_id, positions of its records in sorted order) """
+        order = self.sorted_order()
+        start = 0
+        for end in range(1, len(order) + 1):
+            if end == len(order) or self.series_ids[order[end]] != self.series_ids[order[start]]:
+                yield self.series_ids[order[start]], order[start:end]
+                start = end
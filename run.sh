@@ -10,6 +10,15 @@ case "$1" in
         python update.py -a
         sleep 3600
     done;
+;;
+ 'daemon')
+    python daemon.py
+;;
+ 'sync')
+    while true; do
+        python snapshot.py sync
+        sleep 60
+    done;
 ;;
  'server')
     gunicorn -b 0.0.0.0:8000 server:app
@@ -0,0 +1,105 @@
+import gzip
+import heapq
+import json
+import math
+import re
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+LABEL_SUFFIXES = ('_name', '_text', '_title', '_desc')
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(txt):
+    return TOKEN_RE.findall(txt.lower())
+
+
+def dict_label(row):
+    """ returns label of a meta dictionary row """
+    if isinstance(row, str):
+        return row
+    if isinstance(row, list):
+        return row[1] if len(row) > 1 else ''
+    labels = [v for k, v in row.items() if k.endswith(LABEL_SUFFIXES)]
+    if len(labels) == 0 and 'column1' in row:
+        labels = [row['column1']]
+    return " ".join(labels)
+
+
+def series_text(series, meta):
+    """ returns title of series joined with labels of its dictionary codes """
+    txt = [series.get('series_title', '')]
+    for k, v in series.items():
+        name = k[:-len('_code')] if k.endswith('_code') else k
+        d = meta.get(name)
+        if isinstance(d, dict) and v in d:
+            txt.append(dict_label(d[v]))
+    return " ".join(txt)
+
+
+def build_search_index(series_generator, meta):
+    """ returns inverted index over series titles and dictionary labels.
+
+    docs: [[series_id, series_title, token_count]], terms: {token: [doc, tf, doc, tf, ...]}
+    """
+    docs = []
+    terms = dict()
+    for s in series_generator:
+        tokens = tokenize(series_text(s, meta))
+        doc = len(docs)
+        docs.append([s['id'], s.get('series_title', ''), len(tokens)])
+        tf = dict()
+        for t in tokens:
+            tf[t] = tf.get(t, 0) + 1
+        for t, c in tf.items():
+            p = terms.get(t)
+            if p is None:
+                p = terms[t] = []
+            p.append(doc)
+            p.append(c)
+    return {'docs': docs, 'terms': terms}
+
+
+class SearchIndex:
+
+    def __init__(self, index):
+        self.docs = index['docs']
+        self.terms = index['terms']
+        self.avg_len = max(1, sum(d[2] for d in self.docs) / max(1, len(self.docs)))
+
+    @staticmethod
+    def load(path):
+        with gzip.open(path, 'rt') as f:
+            return SearchIndex(json.loads(f.read()))
+
+    def search(self, query, limit):
+        """ returns count of series matching all known query terms and best `limit` of them [(score, id, title)].
+
+        Query terms absent in the index are ignored. Series are ranked with BM25.
+        """
+        postings = [self.terms[t] for t in set(tokenize(query)) if t in self.terms]
+        if len(postings) == 0:
+            return 0, []
+        postings.sort(key=len)
+        n = len(self.docs)
+        scores = None
+        for p in postings:
+            df = len(p) // 2
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            term_scores = dict()
+            for i in range(0, len(p), 2):
+                doc = p[i]
+                if scores is not None and doc not in scores:
+                    continue
+                tf = p[i + 1]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.docs[doc][2] / self.avg_len)
+                term_scores[doc] = idf * tf * (BM25_K1 + 1) / (tf + norm)
+            if scores is not None:
+                for doc in term_scores:
+                    term_scores[doc] += scores[doc]
+            scores = term_scores
+            if len(scores) == 0:
+                break
+        best = heapq.nlargest(limit, scores.items(), key=lambda i: (i[1], -i[0]))
+        return len(scores), [(score, self.docs[doc][0], self.docs[doc][1]) for doc, score in best]
@@ -1,18 +1,107 @@
+import bisect
+import collections
+import functools
 import gzip
 import json
 import os
+import threading
+import urllib.parse
 import zipfile
 
-from flask import Flask, jsonify, safe_join, send_file, request
-from werkzeug.exceptions import NotFound
+from flask import Flask, safe_join, send_file, request, Response
+from werkzeug.exceptions import NotFound, BadRequest, Gone
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from config import DEBUG, WRK_DB_DIR, DB_LIST_FILE_NAME, META_FILE_NAME, SERIES_PREFIX, FILE_NAME_DELIMITER, JSON_SUFFIX
+from config import DEBUG, WRK_DB_DIR, DB_LIST_FILE_NAME, META_FILE_NAME, SERIES_PREFIX, FILE_NAME_DELIMITER, \
+    JSON_SUFFIX, DATA_PREFIX, ASPECT_PREFIX, SEARCH_FILE_NAME, SEARCH_CACHE_BYTES, SEARCH_PAGE_SIZE, \
+    SEARCH_MAX_PAGE_SIZE, CHANGES_FILE_NAME, LATEST_FILE_NAME, LATEST_CACHE_BYTES, TRANSFORM_CACHE_SIZE, \
+    CHANGES_CACHE_SIZE, ROUTING_FILE_NAME, SERIES_BATCH_MAX, JSON_GZ_SUFFIX, ZIP_SUFFIX
 from lock import shared_lock
+from changes import read_changes, merge_changes
+from formats import MIMETYPES, JSON, COLUMNAR, CSV, BINARY, dumps, render, to_columnar
+from search import SearchIndex
+from storage import read_generation, read_series, read_series_many
+from transforms import TRANSFORMS, DEFAULT_WINDOW, transform
 
 app = Flask("blsgov-datasource")
 app.wsgi_app = ProxyFix(app.wsgi_app)
 
+GENERATION_HEADER = 'X-Data-Generation'
+
+
+def generation_etag(db_id, db_path, fmt=JSON):
+    generation = read_generation(db_path)
+    etag = db_id.lower() + '-' + str(generation)
+    return (etag if fmt == JSON else etag + '-' + fmt), generation
+
+
+def not_modified(etag, generation):
+    """ returns 304 response if the client already has this generation of the resource """
+    if etag not in request.if_none_match:
+        return None
+    response = Response(status=304)
+    response.vary.add('Accept')
+    response.set_etag(etag)
+    response.headers[GENERATION_HEADER] = str(generation)
+    return response
+
+
+def with_generation(response, etag, generation):
+    response.set_etag(etag)
+    response.headers[GENERATION_HEADER] = str(generation)
+    return response
+
+
+def json_response(obj):
+    """ compact json response, unlike jsonify it is not pretty printed in debug mode """
+    return Response(dumps(obj), mimetype=MIMETYPES[JSON])
+
+
+def response_format(formats):
+    """ returns format of the response chosen by the `format` argument or the Accept header """
+    fmt = request.args.get('format')
+    if fmt is None:
+        mimetype = request.accept_mimetypes.best_match([MIMETYPES[f] for f in formats], MIMETYPES[JSON])
+        return next(f for f in formats if MIMETYPES[f] == mimetype)
+    if fmt not in formats:
+        raise BadRequest("unknown format, available: " + ", ".join(formats))
+    return fmt
+
+
+def formatted_response(body, fmt):
+    response = Response(body, mimetype=MIMETYPES[fmt])
+    response.vary.add('Accept')
+    return response
+
+
+class SizedCache:
+    """ least recently used cache bounded by the total size of its values rather than by their count,
+    a value larger than max_size is not cached """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """ returns value of key, load() returns value and size of a missing one """
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+                return item[0]
+        value, size = load()
+        if size > self.max_size:
+            return value
+        with self.lock:
+            if key not in self.items:
+                self.items[key] = (value, size)
+                self.size += size
+            while self.size > self.max_size:
+                self.size -= self.items.popitem(last=False)[1][1]
+        return value
+
 
 @app.route('/api/files/<path:path>')
 @app.route('/api/files/')
@@ -24,7 +113,7 @@ def get_files(path=''):
         if os.path.isdir(path):
             lst = os.listdir(path)
             lst = [{"name": i, "type": 'dir' if os.path.isdir(os.path.join(path, i)) else 'file'} for i in lst]
-            return jsonify(lst)
+            return json_response(lst)
         else:
             return send_file(path, as_attachment=True)
 
@@ -40,30 +129,37 @@ def get_db_list(db_id=None):
             db = next((d for d in dbs if d['id'] == db_id), None)
             if db is None:
                 raise NotFound()
-            jsonify(db)
-        return jsonify(dbs)
+            return json_response(db)
+        return json_response(dbs)
 
 
 @app.route('/api/db/<db_id>/meta')
 def get_meta(db_id=None):
     with shared_lock():
-        path = safe_join(WRK_DB_DIR, db_id.lower())
-        path = os.path.join(path, META_FILE_NAME)
+        db_path = safe_join(WRK_DB_DIR, db_id.lower())
+        path = os.path.join(db_path, META_FILE_NAME)
         if not os.path.exists(path) or not os.path.isfile(path):
             raise NotFound()
+        etag, generation = generation_etag(db_id, db_path)
+        response = not_modified(etag, generation)
+        if response is not None:
+            return response
         with gzip.open(path, 'rt') as f:
             data = f.read()
         data = json.loads(data)
-        return jsonify(data)
+        return with_generation(json_response(data), etag, generation)
 
 
 @app.route('/api/db/<db_id>/series/')
 @app.route('/api/db/<db_id>/series/<series_id>')
 def get_series(db_id=None, series_id=None):
+    """ returns series or a page of series list as json, columnar json or csv (see formats.py) """
     with shared_lock():
         last_series_id = request.args.get('after')
+        fmt = response_format([JSON, COLUMNAR, CSV])
         db_path = safe_join(WRK_DB_DIR, db_id.lower())
-
+        if not os.path.isdir(db_path):
+            raise NotFound()
         files = os.listdir(db_path)
         files = [{
             "from": f.split(FILE_NAME_DELIMITER)[1],
@@ -72,40 +168,89 @@ def get_series(db_id=None, series_id=None):
         } for f in files if f.startswith(SERIES_PREFIX)]
         files.sort(key=lambda f: f['from'])
         if series_id is not None:
-            series_file = next((f for f in files if f['from'] <= series_id <= f['to']), None)
-        elif last_series_id is None:
+            # the series must exist before a client's etag is honoured
+            series = find_series(db_path, files, series_id)
+            etag, generation = generation_etag(db_id, db_path, fmt)
+            response = not_modified(etag, generation)
+            if response is not None:
+                return response
+            return with_generation(single_series_response(series, fmt), etag, generation)
+
+        etag, generation = generation_etag(db_id, db_path, fmt)
+        response = not_modified(etag, generation)
+        if response is not None:
+            return response
+        if last_series_id is None:
             series_file = files[0]
         else:
             series_file = next((f for f in files if f['to'] > last_series_id), None)
         if series_file is None:
-            return jsonify([])
+            return json_response([])
 
-        series_path = os.path.join(db_path, series_file['name'])
-        with gzip.open(series_path, 'rt') as f:
+        with gzip.open(os.path.join(db_path, series_file['name']), 'rt') as f:
             series = f.read()
         series = json.loads(series)
 
-        if series_id is not None:
-            series = next((s for s in series if s['id'] == series_id), None)
-            if series is None:
-                raise NotFound()
-            return jsonify(series)
-
         if last_series_id is not None:
             series = [s for s in series if s['id'] > last_series_id]
 
-        return {
-            'data': series,
-            'next_page': None if files.index(series_file) >= len(files) - 1 else ('?after=' + series[-1]['id'])
-            # TODO better pagination: count, offset, limit
-        }
+        next_page = None if files.index(series_file) >= len(files) - 1 else ('?after=' + series[-1]['id'])
+        # TODO better pagination: count, offset, limit
+        if fmt == CSV:
+            response = formatted_response(render(series, CSV), CSV)
+            if next_page is not None:
+                response.headers['Link'] = '<' + next_page + '>; rel="next"'
+        else:
+            response = formatted_response(dumps({
+                'data': series if fmt == JSON else to_columnar(series),
+                'next_page': next_page,
+            }), fmt)
+        return with_generation(response, etag, generation)
+
+
+def find_series(db_path, files, series_id):
+    """ returns series from its shard, raises NotFound if it is absent """
+    series_file = next((f for f in files if f['from'] <= series_id <= f['to']), None)
+    if series_file is None:
+        raise NotFound()
+    series_path = os.path.join(db_path, series_file['name'])
+    try:
+        series = read_series(series_path, series_id)
+    except FileNotFoundError:  # built without index
+        with gzip.open(series_path, 'rt') as f:
+            series = next((s for s in json.loads(f.read()) if s['id'] == series_id), None)
+    if series is None:
+        raise NotFound()
+    return series
+
+
+def single_series_response(series, fmt):
+    """ the columnar and csv forms of a series are those of a list of one series """
+    if fmt == JSON:
+        return formatted_response(dumps(series), fmt)
+    return formatted_response(render([series], fmt), fmt)
 
 
 @app.route('/api/db/<db_id>/series/<series_id>/<kind>')
 def get_data(db_id, series_id=None, kind=None):
+    """ returns observations of series, `transform` (see transforms.py) and `window` transform them;
+    data is available in all formats of formats.py, aspect in all but binary """
     with shared_lock():
         prefix = kind + FILE_NAME_DELIMITER
+        if prefix not in (DATA_PREFIX, ASPECT_PREFIX):
+            raise NotFound()
+        fmt = response_format([JSON, COLUMNAR, CSV, BINARY] if prefix == DATA_PREFIX else [JSON, COLUMNAR, CSV])
+        transform_name = request.args.get('transform')
+        if transform_name is not None and transform_name not in TRANSFORMS:
+            raise BadRequest("unknown transform, available: " + ", ".join(TRANSFORMS.keys()))
+        if transform_name is not None and prefix != DATA_PREFIX:
+            raise BadRequest("transform applies to data only")
+        window = request.args.get('window', DEFAULT_WINDOW, type=int)
+        if window < 1:
+            raise BadRequest("window must be positive")
         db_path = safe_join(WRK_DB_DIR, db_id.lower())
+        if not os.path.isdir(db_path):
+            raise NotFound()
         files = os.listdir(db_path)
         files = [{
             "from": f.split(FILE_NAME_DELIMITER)[1],
@@ -118,12 +263,272 @@ def get_data(db_id, series_id=None, kind=None):
         path = os.path.join(db_path, data_file['name'])
         with zipfile.ZipFile(path, 'r') as z:
             try:
-                content = z.read(series_id + JSON_SUFFIX)
+                z.getinfo(series_id + JSON_SUFFIX)
             except KeyError:
                 raise NotFound()
-        content = content.decode()
-        content = json.loads(content)
-        return jsonify(content)
+        etag, generation = generation_etag(db_id, db_path, fmt)
+        response = not_modified(etag, generation)
+        if response is not None:
+            return response
+        if transform_name is None:
+            content = read_data(path, series_id)
+        else:
+            content = transformed_data(path, series_id, transform_name, window, generation)
+        return with_generation(formatted_response(render(content, fmt), fmt), etag, generation)
+
+
+def read_data(path, series_id):
+    with zipfile.ZipFile(path, 'r') as z:
+        try:
+            content = z.read(series_id + JSON_SUFFIX)
+        except KeyError:
+            raise NotFound()
+    content = content.decode()
+    return json.loads(content)
+
+
+@functools.lru_cache(maxsize=TRANSFORM_CACHE_SIZE)
+def transformed_data(path, series_id, transform_name, window, generation):
+    """ cached per generation, the result must not be modified """
+    return transform(read_data(path, series_id), transform_name, window)
+
+
+@functools.lru_cache(maxsize=CHANGES_CACHE_SIZE)
+def load_changes(db_path, generation):
+    """ cached per generation, the result must not be modified """
+    return read_changes(db_path)
+
+
+@app.route('/api/db/<db_id>/changes')
+def get_changes(db_id):
+    """ returns ids of series added, removed or changed after generation `since`,
+    with `observations=true` also the new and changed observations and [year, period] of removed ones """
+    with shared_lock():
+        since = request.args.get('since', type=int)
+        if since is None:
+            raise BadRequest("since is required")
+        with_observations = request.args.get('observations', 'false').lower() == 'true'
+        db_path = safe_join(WRK_DB_DIR, db_id.lower())
+        if not os.path.isfile(os.path.join(db_path, CHANGES_FILE_NAME)):
+            raise NotFound()
+        etag, generation = generation_etag(db_id, db_path)
+        response = not_modified(etag, generation)
+        if response is not None:
+            return response
+        changes = merge_changes(load_changes(db_path, generation), since, generation, with_observations)
+        if changes is None:
+            raise Gone("history of changes does not reach generation " + str(since))
+        changes['generation'] = generation
+        changes['since'] = since
+        return with_generation(json_response(changes), etag, generation)
+
+
+latest_tables = SizedCache(LATEST_CACHE_BYTES)
+
+
+def load_latest(path):
+    """ returns table and length of its json """
+    with gzip.open(path, 'rt') as f:
+        txt = f.read()
+    return json.loads(txt), len(txt)
+
+
+@app.route('/api/db/<db_id>/latest')
+def get_latest(db_id):
+    """ returns last observations of series listed in `series` (comma separated) or of series
+    matching facet filters, e.g. ?area_code=0000&seasonal=S; a filter may list several values """
+    with shared_lock():
+        db_path = safe_join(WRK_DB_DIR, db_id.lower())
+        path = os.path.join(db_path, LATEST_FILE_NAME)
+        if not os.path.isfile(path):
+            raise NotFound()
+        etag, generation = generation_etag(db_id, db_path)
+        response = not_modified(etag, generation)
+        if response is not None:
+            return response
+        # the result must not be modified, a table larger than LATEST_CACHE_BYTES is read per request
+        table = latest_tables.get((path, generation), lambda: load_latest(path))
+        fields = table['fields']
+        series = table['series']
+
+        series_ids = request.args.get('series')
+        if series_ids is not None:
+            series_ids = [i for i in series_ids.split(',') if i in series]
+        else:
+            series_ids = sorted(series.keys())
+        filters = [(fields.index(k), set(v.split(','))) for k, v in request.args.items() if k in fields]
+        series_ids = [i for i in series_ids if all(series[i][0][f] in v for f, v in filters)]
+
+        return with_generation(json_response([{
+            'id': i,
+            'facets': dict(zip(fields, series[i][0])),
+            'observations': series[i][1],
+        } for i in series_ids]), etag, generation)
+
+
+@functools.lru_cache(maxsize=1)
+def load_routing(path, mtime_ns):
+    """ returns starts of the ranges and the ranges of the routing file written by storage.write_routing """
+    with gzip.open(path, 'rt') as f:
+        ranges = json.loads(f.read())
+    return [r[0] for r in ranges], ranges
+
+
+def route(routing, series_id):
+    """ returns [from, to, db_id] of the series shards which may contain series_id, shards of several dbs
+    if their ranges overlap """
+    starts, ranges = routing
+    i = bisect.bisect_right(starts, series_id) - 1
+    if i < 0 or ranges[i][1] < series_id:
+        return []
+    return [r for r in ranges[i][2] if r[0] <= series_id <= r[1]]
+
+
+def batch_series_ids():
+    """ returns ids of a batch: `ids` (comma separated) or posted json list or {"ids": [...]} """
+    if request.method == 'POST':
+        ids = request.get_json(silent=True)
+        if isinstance(ids, dict):
+            ids = ids.get('ids')
+        if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+            raise BadRequest("ids must be a list of strings")
+    else:
+        ids = request.args.get('ids', '').split(',')
+    ids = list(dict.fromkeys(i for i in ids if len(i) > 0))
+    if len(ids) == 0:
+        raise BadRequest("ids are required")
+    if len(ids) > SERIES_BATCH_MAX:
+        raise BadRequest("at most " + str(SERIES_BATCH_MAX) + " ids per request")
+    return ids
+
+
+def read_shard_series(path, series_ids):
+    try:
+        return read_series_many(path, series_ids)
+    except FileNotFoundError:
+        pass  # built without index
+    if not os.path.isfile(path):
+        return dict()
+    with gzip.open(path, 'rt') as f:
+        series = json.loads(f.read())
+    series_ids = set(series_ids)
+    return dict((s['id'], s) for s in series if s['id'] in series_ids)
+
+
+def read_shard_data(path, series_ids):
+    """ returns dict series_id -> observations, the zip of the shard is opened once """
+    result = dict()
+    if not os.path.isfile(path):
+        return result
+    with zipfile.ZipFile(path, 'r') as z:
+        for series_id in series_ids:
+            try:
+                result[series_id] = json.loads(z.read(series_id + JSON_SUFFIX).decode())
+            except KeyError:
+                pass
+    return result
+
+
+@app.route('/api/series', methods=['GET', 'POST'])
+def get_series_batch():
+    """ returns series of a batch of ids of any dbs grouped by db, absent ids are listed in `missing`;
+    with `data=true` series include their observations """
+    with shared_lock():
+        series_ids = batch_series_ids()
+        with_data = request.args.get('data', 'false').lower() == 'true'
+        try:
+            routing = load_routing(ROUTING_FILE_NAME, os.stat(ROUTING_FILE_NAME).st_mtime_ns)
+        except FileNotFoundError:
+            raise NotFound()
+        shards = dict()
+        for series_id in series_ids:
+            for r in route(routing, series_id):
+                shards.setdefault(tuple(r), []).append(series_id)
+
+        dbs = dict()
+        found_ids = set()
+        for (shard_from, shard_to, db_id), ids in sorted(shards.items()):
+            db_path = os.path.join(WRK_DB_DIR, db_id.lower())
+            shard = shard_from + FILE_NAME_DELIMITER + shard_to
+            found = read_shard_series(os.path.join(db_path, SERIES_PREFIX + shard + JSON_GZ_SUFFIX), ids)
+            if with_data:
+                data = read_shard_data(os.path.join(db_path, DATA_PREFIX + shard + ZIP_SUFFIX), list(found.keys()))
+                for series_id, s in found.items():
+                    s['data'] = data.get(series_id, [])
+            if db_id not in dbs:
+                dbs[db_id] = {'generation': read_generation(db_path), 'series': []}
+            dbs[db_id]['series'] += [found[i] for i in ids if i in found]
+            found_ids.update(found.keys())
+        return json_response({'dbs': dbs, 'missing': [i for i in series_ids if i not in found_ids]})
+
+
+search_indexes = SizedCache(SEARCH_CACHE_BYTES)
+
+
+def load_search_index(path):
+    """ returns index and length of its json """
+    with gzip.open(path, 'rt') as f:
+        txt = f.read()
+    return SearchIndex(json.loads(txt)), len(txt)
+
+
+def search_dbs(db_ids, query, offset, limit):
+    """ returns total count and page of best matches over dbs, called under shared_lock """
+    total = 0
+    found = []
+    for db_id in db_ids:
+        db_path = safe_join(WRK_DB_DIR, db_id.lower())
+        path = os.path.join(db_path, SEARCH_FILE_NAME)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        # keyed by inode and mtime, a replaced file is loaded again
+        index = search_indexes.get((path, st.st_ino, st.st_mtime_ns), lambda: load_search_index(path))
+        count, best = index.search(query, offset + limit)
+        total += count
+        found += [{'db': db_id, 'id': i[1], 'title': i[2], 'score': round(i[0], 4)} for i in best]
+    found.sort(key=lambda r: (-r['score'], r['db'], r['id']))
+    return total, found[offset:offset + limit]
+
+
+def search_response(db_ids, single_db):
+    query = request.args.get('q', '')
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(SEARCH_MAX_PAGE_SIZE, max(1, request.args.get('limit', SEARCH_PAGE_SIZE, type=int)))
+    total, found = search_dbs(db_ids, query, offset, limit)
+    if single_db:
+        for r in found:
+            del r['db']
+    args = dict(request.args)
+    args['offset'] = offset + limit
+    return json_response({
+        'total': total,
+        'data': found,
+        'next_page': None if offset + limit >= total else '?' + urllib.parse.urlencode(args)
+    })
+
+
+@app.route('/api/db/<db_id>/search')
+def search_db(db_id):
+    with shared_lock():
+        db_path = safe_join(WRK_DB_DIR, db_id.lower())
+        if not os.path.isfile(os.path.join(db_path, SEARCH_FILE_NAME)):
+            raise NotFound()
+        return search_response([db_id], True)
+
+
+@app.route('/api/search')
+def search_all():
+    """ searches dbs listed in `db` (comma separated) or all dbs """
+    with shared_lock():
+        db_ids = request.args.get('db')
+        if db_ids is not None:
+            db_ids = [i for i in db_ids.split(',') if len(i) > 0]
+        else:
+            with gzip.open(DB_LIST_FILE_NAME, 'rt') as f:
+                db_ids = [d['id'] for d in json.loads(f.read())]
+        return search_response(db_ids, False)
 
 
 app.debug = DEBUG
@@ -0,0 +1,263 @@
+""" publishing of db generations as immutable snapshots and their sync to replicas.
+
+    python snapshot.py publish          publishes current generations of all dbs to SNAPSHOT_DIR
+    python snapshot.py sync [origin]    pulls changed dbs from origin (a dir or http url, SNAPSHOT_ORIGIN)
+
+Layout of a snapshot dir:
+    objects/<sha[:2]>/<sha256>   content of db files, never changed once written
+    <db>/<generation>.json       manifest: file name -> sha256 and size
+    list.json.gz                 db list, replaced after the manifests of its generations are written
+
+A replica keeps the manifest of each synced db in MANIFEST_FILE_NAME. Files with an unchanged checksum are
+hard linked from the current db dir, the others are fetched and verified, and the new dir replaces the
+current one under the exclusive lock, like a local update does.
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import urllib.error
+
+from config import WORK_DIR, WRK_DB_DIR, DB_LIST_FILE_NAME, ROUTING_FILE_NAME, JSON_SUFFIX, MANIFEST_FILE_NAME, \
+    SNAPSHOT_DIR, SNAPSHOT_ORIGIN, SNAPSHOT_KEEP, SNAPSHOT_GRACE_PERIOD, SNAPSHOT_RETRY_ATTEMPTS, SNAPSHOT_RETRY_DEADLINE
+from http_api import load_file, RetryError, RetryPolicy
+from lock import exclusive_lock
+from storage import read_generation, write_routing
+
+OBJECTS_DIR = 'objects'
+LIST_FILE_NAME = os.path.basename(DB_LIST_FILE_NAME)
+SYNC_DIR = os.path.join(WORK_DIR, 'tmp', 'sync')
+
+fetch_policy = RetryPolicy(max_attempts=SNAPSHOT_RETRY_ATTEMPTS, deadline=SNAPSHOT_RETRY_DEADLINE, final_codes=(404,))
+
+logger = logging.getLogger(__name__)
+
+
+def log(*args):
+    s = " ".join([str(i) for i in args])
+    logger.log(logging.INFO, s)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def object_name(sha):
+    return OBJECTS_DIR + '/' + sha[:2] + '/' + sha
+
+
+def manifest_name(db_id, generation):
+    return db_id.lower() + '/' + str(generation) + JSON_SUFFIX
+
+
+def copy_atomic(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copyfile(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+
+
+def write_json_atomic(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wt') as f:
+        f.write(json.dumps(obj, indent=1))
+    os.replace(path + '.tmp', path)
+
+
+def read_list(path):
+    try:
+        with gzip.open(path, 'rt') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return []
+
+
+def read_manifest(db_path):
+    try:
+        with open(os.path.join(db_path, MANIFEST_FILE_NAME), 'rt') as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def publish_db(db_id, snapshot_dir):
+    """ publishes the current generation of db if it is not published yet, returns its manifest name """
+    db_path = os.path.join(WRK_DB_DIR, db_id.lower())
+    generation = read_generation(db_path)
+    name = manifest_name(db_id, generation)
+    if os.path.exists(os.path.join(snapshot_dir, name)):
+        return name
+    log(db_id + ": publish generation", generation)
+    files = dict()
+    for fn in sorted(os.listdir(db_path)):
+        if fn == MANIFEST_FILE_NAME:
+            continue
+        path = os.path.join(db_path, fn)
+        sha = file_sha256(path)
+        files[fn] = {'sha256': sha, 'size': os.path.getsize(path)}
+        obj = os.path.join(snapshot_dir, object_name(sha))
+        if not os.path.exists(obj):
+            copy_atomic(path, obj)
+    write_json_atomic(os.path.join(snapshot_dir, name), {
+        'id': db_id,
+        'generation': generation,
+        'created': datetime.datetime.now().isoformat(),
+        'files': files,
+    })
+    return name
+
+
+def collect_garbage(snapshot_dir, now=None):
+    """ keeps SNAPSHOT_KEEP newest manifests of each db and the objects they refer to.
+
+    An older manifest is kept until its successor has been published for SNAPSHOT_GRACE_PERIOD,
+    so a replica which read it from the list just before can still fetch its objects.
+    """
+    now = time.time() if now is None else now
+    used = set()
+    for d in os.listdir(snapshot_dir):
+        path = os.path.join(snapshot_dir, d)
+        if d == OBJECTS_DIR or not os.path.isdir(path):
+            continue
+        manifests = sorted((int(fn[:-len(JSON_SUFFIX)]), fn) for fn in os.listdir(path) if fn.endswith(JSON_SUFFIX))
+        kept = []
+        for i, (g, fn) in enumerate(manifests):
+            successor = manifests[i + 1][1] if i + 1 < len(manifests) else None
+            if i < len(manifests) - SNAPSHOT_KEEP and \
+                    now - os.path.getmtime(os.path.join(path, successor)) > SNAPSHOT_GRACE_PERIOD:
+                os.remove(os.path.join(path, fn))
+            else:
+                kept.append(fn)
+        for fn in kept:
+            with open(os.path.join(path, fn), 'rt') as f:
+                manifest = json.loads(f.read())
+            used.update(i['sha256'] for i in manifest['files'].values())
+    objects_dir = os.path.join(snapshot_dir, OBJECTS_DIR)
+    for d in os.listdir(objects_dir) if os.path.isdir(objects_dir) else []:
+        for sha in os.listdir(os.path.join(objects_dir, d)):
+            if sha not in used:
+                os.remove(os.path.join(objects_dir, d, sha))
+
+
+def publish(snapshot_dir=SNAPSHOT_DIR):
+    """ publishes all dbs of the db list, then the list itself """
+    dbs = read_list(DB_LIST_FILE_NAME)
+    for db in dbs:
+        publish_db(db['id'], snapshot_dir)
+        db['generation'] = read_generation(os.path.join(WRK_DB_DIR, db['id'].lower()))
+    list_path = os.path.join(snapshot_dir, LIST_FILE_NAME)
+    with gzip.open(list_path + '.tmp', 'wt') as f:
+        f.write(json.dumps(dbs, indent=1))
+    os.replace(list_path + '.tmp', list_path)
+    collect_garbage(snapshot_dir)
+
+
+def fetch(origin, name, path):
+    """ copies file of snapshot from origin, a dir or http(s) url, raises FileNotFoundError if it is missing """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if origin.startswith('http://') or origin.startswith('https://'):
+        url = origin.rstrip('/') + '/' + name
+        try:
+            load_file(url, path, False, fetch_policy)
+        except urllib.error.HTTPError as e:
+            raise FileNotFoundError(str(e.code) + " " + url)
+    else:
+        shutil.copyfile(os.path.join(origin, name), path)
+
+
+def sync_db(origin, db, local):
+    """ builds the synced dir of db from its published manifest and the local manifest, returns its path """
+    db_path = os.path.join(WRK_DB_DIR, db['id'].lower())
+    sync_path = os.path.join(SYNC_DIR, db['id'].lower())
+    shutil.rmtree(sync_path, ignore_errors=True)
+    os.makedirs(sync_path)
+    fetch(origin, manifest_name(db['id'], db['generation']), os.path.join(sync_path, MANIFEST_FILE_NAME))
+    manifest = read_manifest(sync_path)
+    if manifest is None:
+        raise ValueError(db['id'] + ": invalid manifest")
+    fetched = 0
+    for fn, f in manifest['files'].items():
+        path = os.path.join(sync_path, fn)
+        if local is not None and local['files'].get(fn) == f:
+            try:
+                os.link(os.path.join(db_path, fn), path)
+            except OSError:
+                shutil.copyfile(os.path.join(db_path, fn), path)
+            continue
+        fetch(origin, object_name(f['sha256']), path)
+        if os.path.getsize(path) != f['size'] or file_sha256(path) != f['sha256']:
+            raise ValueError(db['id'] + ": checksum mismatch of " + fn)
+        fetched += 1
+    log(db['id'] + ": fetched", fetched, "of", len(manifest['files']), "files")
+    return sync_path
+
+
+def sync_db_again(origin, db, local):
+    """ sync_db, if a file of the generation is gone, the db list is read again and the db is synced once more.
+    A file is gone when the generation was collected after a newer one was published, db is updated to that one """
+    try:
+        return sync_db(origin, db, local)
+    except FileNotFoundError as e:
+        log(db['id'] + ": generation", db['generation'], "is gone (" + str(e) + "), read the db list again")
+    db.update(next((d for d in read_published(origin) if d['id'] == db['id']), db))
+    return sync_db(origin, db, local)
+
+
+def read_published(origin):
+    list_path = os.path.join(SYNC_DIR, LIST_FILE_NAME)
+    fetch(origin, LIST_FILE_NAME, list_path)
+    return read_list(list_path)
+
+
+def sync(origin=SNAPSHOT_ORIGIN):
+    """ pulls dbs whose published generation differs from the local one, returns ids of updated dbs """
+    if origin is None:
+        raise ValueError("no snapshot origin, pass it or set SNAPSHOT_ORIGIN")
+    os.makedirs(SYNC_DIR, exist_ok=True)
+    published = read_published(origin)
+    cur_db_list = read_list(DB_LIST_FILE_NAME)
+    updated = []
+    for db in published:
+        db_path = os.path.join(WRK_DB_DIR, db['id'].lower())
+        local = read_manifest(db_path)
+        if local is not None and local['generation'] == db['generation']:
+            continue
+        try:
+            sync_path = sync_db_again(origin, db, local)
+        except (IOError, ValueError, RetryError):
+            logger.exception(db['id'] + ": sync failed")
+            continue
+        cur_db_list = [d for d in cur_db_list if d['id'] != db['id']] + [db]
+        with exclusive_lock():
+            shutil.rmtree(db_path, ignore_errors=True)
+            os.makedirs(WRK_DB_DIR, exist_ok=True)
+            os.rename(sync_path, db_path)
+            with gzip.open(DB_LIST_FILE_NAME, 'wt') as f:
+                cur_db_list.sort(key=lambda d: d['modified'])
+                f.write(json.dumps(cur_db_list, indent=1))
+            write_routing(ROUTING_FILE_NAME, [d['id'] for d in cur_db_list])
+        updated.append(db['id'])
+    return updated
+
+
+if __name__ == '__main__':
+    log(sys.argv)
+    if len(sys.argv) > 1 and sys.argv[1] == 'publish':
+        publish()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'sync':
+        origin = sys.argv[2] if len(sys.argv) > 2 else SNAPSHOT_ORIGIN
+        if origin is None:
+            log("no snapshot origin, pass it or set SNAPSHOT_ORIGIN")
+            exit(1)
+        log("updated:", sync(origin))
+    else:
+        log("usage: python snapshot.py publish|sync [origin]")
+        exit(1)
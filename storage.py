@@ -0,0 +1,133 @@
+import bisect
+import json
+import os
+import zlib
+
+from config import GENERATION_FILE_NAME, INDEX_PREFIX, JSON_GZ_SUFFIX, JSON_SUFFIX, SERIES_PER_BLOCK, SERIES_PREFIX, \
+    FILE_NAME_DELIMITER
+from formats import dumps
+
+
+def read_generation(db_path):
+    """ returns generation number of db directory, 0 if unknown """
+    try:
+        with open(os.path.join(db_path, GENERATION_FILE_NAME), 'rt') as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_generation(db_path, generation):
+    with open(os.path.join(db_path, GENERATION_FILE_NAME), 'wt') as f:
+        f.write(str(generation))
+
+
+def series_index_name(shard_name):
+    """ series.<from>.<to>.json.gz -> index.series.<from>.<to>.json """
+    return INDEX_PREFIX + shard_name[:-len(JSON_GZ_SUFFIX)] + JSON_SUFFIX
+
+
+def gzip_compress(data):
+    """ like gzip.compress, but without timestamp in the header, so equal data gives equal files """
+    c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+def write_gzip(path, txt):
+    with open(path, 'wb') as f:
+        f.write(gzip_compress(txt.encode()))
+
+
+def write_series_shard(path, series):
+    """ writes sorted series as a json array of independently gzipped blocks and a block index.
+
+    Concatenated gzip members are still a valid gzip file, so the shard can be read whole with gzip.open,
+    while read_series() inflates only the block containing the requested series.
+    """
+    index = []
+    offset = 0
+    with open(path, 'wb') as f:
+        for i in range(0, len(series), SERIES_PER_BLOCK):
+            block = series[i:i + SERIES_PER_BLOCK]
+            txt = ("[\n" if i == 0 else ",\n") + ",\n".join(dumps(s) for s in block)
+            if i + SERIES_PER_BLOCK >= len(series):
+                txt += "\n]"
+            data = gzip_compress(txt.encode())
+            f.write(data)
+            index.append([block[0]['id'], offset, len(data)])
+            offset += len(data)
+    index_path = os.path.join(os.path.dirname(path), series_index_name(os.path.basename(path)))
+    with open(index_path, 'wt') as f:
+        f.write(json.dumps(index))
+
+
+def read_series_index(path):
+    index_path = os.path.join(os.path.dirname(path), series_index_name(os.path.basename(path)))
+    with open(index_path, 'rt') as f:
+        return json.loads(f.read())
+
+
+def read_block(f, block):
+    """ generator, returns series of a block of an open shard """
+    f.seek(block[1])
+    txt = zlib.decompress(f.read(block[2]), 16 + zlib.MAX_WBITS).decode()
+    for line in txt.split('\n'):
+        if line.startswith('{'):
+            yield json.loads(line.rstrip(','))
+
+
+def read_series(path, series_id):
+    """ returns series from a shard written by write_series_shard, None if it is absent.
+
+    Raises FileNotFoundError if the shard has no index.
+    """
+    return read_series_many(path, [series_id]).get(series_id)
+
+
+def read_series_many(path, series_ids):
+    """ returns dict series_id -> series of ids found in a shard, each block is inflated once.
+
+    Raises FileNotFoundError if the shard has no index.
+    """
+    index = read_series_index(path)
+    starts = [b[0] for b in index]
+    blocks = dict()
+    for series_id in series_ids:
+        i = bisect.bisect_right(starts, series_id) - 1
+        if i >= 0:
+            blocks.setdefault(i, set()).add(series_id)
+    result = dict()
+    with open(path, 'rb') as f:
+        for i in sorted(blocks.keys()):
+            for s in read_block(f, index[i]):
+                if s['id'] in blocks[i]:
+                    result[s['id']] = s
+    return result
+
+
+def write_routing(path, db_ids):
+    """ writes routing of series ids to the series shards of dbs whose dirs are next to path.
+
+    Series ids usually start with the id of their db, but nothing enforces that, so ranges of shards may
+    overlap. Overlapping ranges are grouped, the file is a sorted list of disjoint [from, to, shards] groups,
+    shards are the [from, to, db_id] ranges of the group; an id within a group may be in any of its shards.
+    """
+    shards = []
+    for db_id in db_ids:
+        db_path = os.path.join(os.path.dirname(path), db_id.lower())
+        if not os.path.isdir(db_path):
+            continue
+        for fn in os.listdir(db_path):
+            if fn.startswith(SERIES_PREFIX):
+                nfp = fn.split(FILE_NAME_DELIMITER)
+                shards.append([nfp[1], nfp[2], db_id])
+    shards.sort()
+    ranges = []
+    for shard in shards:
+        if len(ranges) > 0 and shard[0] <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], shard[1])
+            ranges[-1][2].append(shard)
+        else:
+            ranges.append([shard[0], shard[1], [shard]])
+    write_gzip(path + '.tmp', dumps(ranges))
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,51 @@
+import gzip
+import json
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lock
+import server
+from storage import write_generation, write_series_shard
+
+
+class WorkDir:
+    """ a db dir with one series shard and its data, served by server.app """
+
+    def __init__(self, path):
+        self.dbs_dir = os.path.join(path, 'dbs')
+        self.db_path = os.path.join(self.dbs_dir, 'cu')
+        self.list_path = os.path.join(self.dbs_dir, 'list.json.gz')
+        os.makedirs(self.db_path)
+        write_series_shard(os.path.join(self.db_path, 'series.CUA.CUB.json.gz'), [
+            {'id': 'CUA', 'series_title': 'first'},
+            {'id': 'CUB', 'series_title': 'second'},
+        ])
+        self.write_data({'CUA': [1.0], 'CUB': [2.0]})
+        self.set_generation(1)
+
+    def write_data(self, values):
+        with zipfile.ZipFile(os.path.join(self.db_path, 'data.CUA.CUB.zip'), 'w') as z:
+            for sid, vv in values.items():
+                z.writestr(sid + '.json', json.dumps([
+                    {'year': 2020, 'period': 'M%02d' % (i + 1), 'footnote_codes': [], 'value': v}
+                    for i, v in enumerate(vv)]))
+
+    def set_generation(self, generation, list_only=False):
+        if not list_only:
+            write_generation(self.db_path, generation)
+        with gzip.open(self.list_path, 'wt') as f:
+            json.dump([{'id': 'CU', 'name': 'cpi', 'modified': '2026-01-01T00:00:00', 'generation': generation}], f)
+
+
+@pytest.fixture
+def work(tmp_path, monkeypatch):
+    w = WorkDir(str(tmp_path))
+    monkeypatch.setattr(server, 'WRK_DB_DIR', w.dbs_dir)
+    monkeypatch.setattr(server, 'DB_LIST_FILE_NAME', w.list_path)
+    monkeypatch.setattr(lock, 'LOCK_FILE', os.path.join(str(tmp_path), 'lock'))
+    return w
@@ -0,0 +1,27 @@
+from server import SizedCache
+
+
+def test_sized_cache_evicts_least_recently_used():
+    cache = SizedCache(10)
+    loads = []
+
+    def loader(value, size):
+        def load():
+            loads.append(value)
+            return value, size
+        return load
+
+    assert cache.get('a', loader('A', 4)) == 'A'
+    assert cache.get('b', loader('B', 4)) == 'B'
+    assert cache.get('a', loader('A', 4)) == 'A'
+    assert cache.get('c', loader('C', 4)) == 'C'  # evicts b
+    assert cache.get('a', loader('A', 4)) == 'A'
+    assert cache.get('b', loader('B', 4)) == 'B'
+    assert loads == ['A', 'B', 'C', 'B']
+    assert cache.size <= 10
+
+
+def test_sized_cache_skips_values_larger_than_limit():
+    cache = SizedCache(10)
+    assert cache.get('a', lambda: ('A', 11)) == 'A'
+    assert len(cache.items) == 0 and cache.size == 0
@@ -0,0 +1,129 @@
+import http.client
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+import server
+from client import Client, ApiError
+
+
+class CountingTransport:
+    """ wraps a transport, records path and status of every request """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.requests = []
+
+    def request(self, path, headers):
+        status, response_headers, body = self.transport.request(path, headers)
+        self.requests.append((path, status))
+        return status, response_headers, body
+
+    def close(self):
+        self.transport.close()
+
+    def count(self, path):
+        return len([r for r in self.requests if r[0] == path])
+
+
+def counting_client(tmp_path, **kwargs):
+    client = Client(app=server.app, cache_dir=str(tmp_path / 'cache'), **kwargs)
+    client.transport = CountingTransport(client.transport)
+    return client
+
+
+DATA_PATH = '/api/db/CU/series/CUA/data'
+
+
+def test_flask_transport(work):
+    with Client(app=server.app) as client:
+        assert [d['id'] for d in client.list_dbs()] == ['CU']
+        assert client.get_series('CU', 'CUA')['series_title'] == 'first'
+        assert [o['value'] for o in client.get_data('CU', 'CUB')] == [2.0]
+        assert client.get_series_many('CU', ['CUA', 'CUX']) == {
+            'CUA': {'id': 'CUA', 'series_title': 'first'},
+            'CUX': None,
+        }
+        with pytest.raises(ApiError) as e:
+            client.get_meta('CU')
+        assert e.value.status == 404
+
+
+def test_cache_is_used_while_generation_is_unchanged(work, tmp_path):
+    with counting_client(tmp_path) as client:
+        assert client.get_data('CU', 'CUA')[0]['value'] == 1.0
+        work.write_data({'CUA': [5.0], 'CUB': [2.0]})  # not visible without a new generation
+        assert client.get_data('CU', 'CUA')[0]['value'] == 1.0
+        assert client.transport.count(DATA_PATH) == 1
+
+
+def test_new_generation_invalidates_cache(work, tmp_path):
+    with counting_client(tmp_path, generation_ttl=0) as client:
+        assert client.get_data('CU', 'CUA')[0]['value'] == 1.0
+        work.write_data({'CUA': [5.0], 'CUB': [2.0]})
+        work.set_generation(2)
+        assert client.get_data('CU', 'CUA')[0]['value'] == 5.0
+        assert client.transport.requests[-1] == (DATA_PATH, 200)
+
+
+def test_generation_is_refreshed_after_ttl(work, tmp_path):
+    with counting_client(tmp_path, generation_ttl=3600) as client:
+        client.get_data('CU', 'CUA')
+        client.get_data('CU', 'CUA')
+        work.write_data({'CUA': [5.0], 'CUB': [2.0]})
+        work.set_generation(2)
+        assert client.get_data('CU', 'CUA')[0]['value'] == 1.0
+        assert client.transport.count('/api/db/') == 1
+        client.generation_ttl = 0
+        assert client.get_data('CU', 'CUA')[0]['value'] == 5.0
+        assert client.transport.count('/api/db/') == 2
+
+
+def test_unchanged_db_is_revalidated(work, tmp_path):
+    with counting_client(tmp_path, generation_ttl=0) as client:
+        client.get_data('CU', 'CUA')
+        work.set_generation(2, list_only=True)  # the list moved on, the db files did not
+        assert client.get_data('CU', 'CUA')[0]['value'] == 1.0
+        assert client.transport.requests[-1] == (DATA_PATH, 304)
+
+
+def test_disk_cache_is_shared_by_clients(work, tmp_path):
+    with counting_client(tmp_path) as client:
+        client.get_data('CU', 'CUA')
+    with counting_client(tmp_path) as client:
+        assert client.get_data('CU', 'CUA')[0]['value'] == 1.0
+        assert client.transport.count(DATA_PATH) == 0
+
+
+def test_etag_of_missing_resource_is_not_honoured(work):
+    c = server.app.test_client()
+    etag = c.get('/api/db/CU/series/CUA').headers['ETag']
+    assert c.get('/api/db/CU/series/CUA', headers={'If-None-Match': etag}).status_code == 304
+    assert c.get('/api/db/CU/series/CUX', headers={'If-None-Match': etag}).status_code == 404
+    assert c.get('/api/db/CU/series/CUX/data', headers={'If-None-Match': etag}).status_code == 404
+    assert c.get('/api/db/XX/series/CUA', headers={'If-None-Match': etag}).status_code == 404
+
+
+def test_http_transport_reuses_connections(work):
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    connections = []
+
+    class CountingConnection(http.client.HTTPConnection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            connections.append(self)
+
+    try:
+        with Client('http://127.0.0.1:' + str(httpd.server_port), pool_size=2) as client:
+            client.transport.connection_class = CountingConnection
+            for i in range(5):
+                assert client.get_series('CU', 'CUA')['id'] == 'CUA'
+            assert len(connections) == 1
+            data = client.get_data_many('CU', ['CUA', 'CUB'] * 4)
+            assert data['CUB'][0]['value'] == 2.0
+            assert len(connections) <= 2
+    finally:
+        httpd.shutdown()
@@ -0,0 +1,21 @@
+import os
+
+import server
+from storage import write_routing, write_series_shard
+
+
+def test_overlapping_ranges_route_to_every_db(work, monkeypatch):
+    en_path = os.path.join(work.dbs_dir, 'en')
+    os.makedirs(en_path)
+    write_series_shard(os.path.join(en_path, 'series.CUA0.CUC.json.gz'), [
+        {'id': 'CUA0', 'series_title': 'en first'},
+        {'id': 'CUC', 'series_title': 'en second'},
+    ])
+    routing_path = os.path.join(work.dbs_dir, 'routing.json.gz')
+    write_routing(routing_path, ['CU', 'EN'])
+    monkeypatch.setattr(server, 'ROUTING_FILE_NAME', routing_path)
+    with server.app.test_client() as client:
+        r = client.get('/api/series?ids=CUB,CUA0,CUA,CUX').get_json()
+    assert [s['id'] for s in r['dbs']['CU']['series']] == ['CUB', 'CUA']
+    assert [s['id'] for s in r['dbs']['EN']['series']] == ['CUA0']
+    assert r['missing'] == ['CUX']
@@ -0,0 +1,29 @@
+import json
+
+import server
+from transforms import transform
+
+
+def observation(year, period, value):
+    return {'year': year, 'period': period, 'footnote_codes': [], 'value': value}
+
+
+def test_non_finite_values_are_none():
+    observations = [observation(2020, 'M01', 0.0), observation(2020, 'M02', 1.0), observation(2020, 'M04', 2.0)]
+    assert [o['value'] for o in transform(observations, 'pct_change')] == [None, None, None]
+    assert [o['value'] for o in transform(observations, 'change')] == [None, 1.0, None]
+
+
+def test_annual_periods_are_one_frequency():
+    observations = [observation(2019, 'A01', 1.0), observation(2020, 'M13', 3.0)]
+    assert [o['value'] for o in transform(observations, 'change')] == [None, 2.0]
+
+
+def test_transformed_data_is_valid_json(work):
+    work.write_data({'CUA': [0.0, 1.0], 'CUB': [2.0]})
+    with server.app.test_client() as client:
+        response = client.get('/api/db/CU/series/CUA/data?transform=pct_change')
+        assert response.status_code == 200
+        assert [o['value'] for o in json.loads(response.get_data(as_text=True))] == [None, None]
+        response = client.get('/api/db/CU/series/CUA/aspect?transform=change')
+        assert response.status_code == 400
@@ -0,0 +1,63 @@
+import gzip
+import os
+
+import pytest
+
+from writers import ShardWriters, TMP_SUFFIX
+
+
+def read(path):
+    with gzip.open(path, 'rt') as f:
+        return f.read()
+
+
+def gzip_members(path):
+    with open(path, 'rb') as f:
+        return f.read().count(b'\x1f\x8b\x08')
+
+
+def test_evicted_files_are_reopened_in_append_mode(tmp_path):
+    paths = [str(tmp_path / ('shard%d.gz' % i)) for i in range(3)]
+    expected = dict((p, '') for p in paths)
+    with ShardWriters(paths, max_open=1, buffer_bytes=64) as writers:
+        for i in range(200):
+            p = paths[i * 7 % 3]
+            line = 'line %d of %s\n' % (i, os.path.basename(p))
+            writers.write(p, line)
+            expected[p] += line
+        assert len(writers.files) <= 1
+    for p in paths:
+        assert read(p) == expected[p]
+        assert gzip_members(p) > 1
+        assert not os.path.exists(p + TMP_SUFFIX)
+
+
+def test_buffers_are_written_on_close(tmp_path):
+    path = str(tmp_path / 'shard.gz')
+    with ShardWriters([path]) as writers:
+        writers.write(path, 'a\n')
+        writers.write(path, 'b\n')
+        assert not os.path.exists(path)
+    assert read(path) == 'a\nb\n'
+    assert gzip_members(path) == 1
+
+
+def test_files_without_records_are_empty(tmp_path):
+    paths = [str(tmp_path / 'a.gz'), str(tmp_path / 'b.gz')]
+    with ShardWriters(paths) as writers:
+        writers.write(paths[0], 'x\n')
+    assert read(paths[1]) == ''
+
+
+def test_exception_leaves_no_partial_files(tmp_path):
+    paths = [str(tmp_path / 'a.gz'), str(tmp_path / 'b.gz')]
+    with open(paths[0], 'wb') as f:
+        f.write(b'previous')
+    with pytest.raises(ValueError):
+        with ShardWriters(paths, max_open=1, buffer_bytes=8) as writers:
+            for i in range(100):
+                writers.write(paths[i % 2], 'line %d\n' % i)
+            raise ValueError()
+    assert sorted(os.listdir(str(tmp_path))) == ['a.gz']
+    with open(paths[0], 'rb') as f:
+        assert f.read() == b'previous'
@@ -0,0 +1,101 @@
+""" server side transformations of series observations.
+
+Observations are split by frequency (monthly M01-M12, quarterly Q01-Q04, semiannual S01-S02,
+annual ANNUAL_PERIODS), each frequency is laid out on a dense array of periods, so lags and windows
+count periods rather than observations. Gaps and other non-finite results give None (null in json).
+"""
+import numpy as np
+
+from config import ANNUAL_PERIODS
+
+FREQUENCIES = {
+    'M': 12,
+    'Q': 4,
+    'S': 2,
+}
+
+DEFAULT_WINDOW = 3
+
+
+def period_position(period):
+    """ returns (periods per year, index within year) of period code, None for unknown codes """
+    if period in ANNUAL_PERIODS:
+        return 1, 0
+    ppy = FREQUENCIES.get(period[:1])
+    if ppy is None or not period[1:].isdigit():
+        return None
+    i = int(period[1:]) - 1
+    if i < 0 or i >= ppy:
+        return None
+    return ppy, i
+
+
+def lag(dense, k):
+    r = np.full_like(dense, np.nan)
+    if k < len(dense):
+        r[k:] = dense[:len(dense) - k]
+    return r
+
+
+def rolling_mean(dense, window):
+    r = np.full_like(dense, np.nan)
+    if window > len(dense):
+        return r
+    missing = np.isnan(dense)
+    total = np.concatenate([[0], np.cumsum(np.where(missing, 0, dense))])
+    missing = np.concatenate([[0], np.cumsum(missing)])
+    s = (total[window:] - total[:-window]) / window
+    r[window - 1:] = np.where(missing[window:] - missing[:-window] > 0, np.nan, s)
+    return r
+
+
+def change(dense, ppy, window):
+    return dense - lag(dense, 1)
+
+
+def pct_change(dense, ppy, window):
+    return (dense / lag(dense, 1) - 1) * 100
+
+
+def yoy_change(dense, ppy, window):
+    return dense - lag(dense, ppy)
+
+
+def yoy_pct_change(dense, ppy, window):
+    return (dense / lag(dense, ppy) - 1) * 100
+
+
+def annualized_rate(dense, ppy, window):
+    return ((dense / lag(dense, 1)) ** ppy - 1) * 100
+
+
+def rolling(dense, ppy, window):
+    return rolling_mean(dense, window)
+
+
+TRANSFORMS = {
+    'change': change,
+    'pct_change': pct_change,
+    'yoy_change': yoy_change,
+    'yoy_pct_change': yoy_pct_change,
+    'annualized_rate': annualized_rate,
+    'rolling_mean': rolling,
+}
+
+
+def transform(observations, name, window=DEFAULT_WINDOW):
+    """ returns copy of observations with values replaced by the transformation `name` """
+    fn = TRANSFORMS[name]
+    n = len(observations)
+    values = np.array([o['value'] for o in observations], dtype=np.float64)
+    result = np.full(n, np.nan)
+    positions = [period_position(o['period']) for o in observations]
+    for ppy in set(p[0] for p in positions if p is not None):
+        rows = np.array([i for i in range(n) if positions[i] is not None and positions[i][0] == ppy], dtype=np.int64)
+        t = np.array([observations[i]['year'] * ppy + positions[i][1] for i in rows], dtype=np.int64)
+        t -= t.min()
+        dense = np.full(t.max() + 1, np.nan)
+        dense[t] = values[rows]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            result[rows] = fn(dense, ppy, window)[t]
+    return [dict(o, value=float(v) if np.isfinite(v) else None) for o, v in zip(observations, result)]
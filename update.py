@@ -1,6 +1,6 @@
+import bisect
 import datetime
 import gzip
-import itertools
 import json
 import logging
 import os
@@ -9,12 +9,26 @@ import sys
 import zipfile
 
 from blsgov_api import load_db_list, get_loader
+from changes import write_changes
+from checkpoint import Checkpoint
+from formats import dumps
+from http_api import get_stats, RetryError
 from config import WRK_DB_DIR, META_FILE_NAME, TMP_DB_DIR, DATA_PREFIX, ASPECT_PREFIX, \
     SERIES_PREFIX, JSON_GZ_SUFFIX, JSON_SUFFIX, ZIP_SUFFIX, DB_LIST_FILE_NAME, MAX_SERIES_PER_BATCH, \
-    MAX_DATA_PER_BATCH, MODIFIED_LESS_THAN
+    MAX_DATA_PER_BATCH, MODIFIED_LESS_THAN, SEARCH_FILE_NAME, INDEX_PREFIX, LATEST_FILE_NAME, LATEST_OBSERVATIONS, \
+    ANNUAL_PERIODS, SNAPSHOT_DIR, ROUTING_FILE_NAME
 from lock import exclusive_lock
+from records import FootnoteTable, RecordBatch, format_record, SERIES_ID
+from search import build_search_index
+from snapshot import publish
+from storage import read_generation, write_generation, write_series_shard, series_index_name, write_gzip, \
+    write_routing
+from writers import ShardWriters
 
 TMP_PREFIX = 'tmp.'
+TSV_GZ_SUFFIX = '.tsv.gz'
+TMP_LATEST_PREFIX = TMP_PREFIX + 'latest.'
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 logger = logging.getLogger(__name__)
 
 
@@ -26,34 +40,68 @@ def log(*args):
 def update_dbs(db_ids=None, force_all=False):
     log('load db lists')
 
-    new_db_list = load_db_list()
-    cur_db_list = []
+    cur_db_list = read_db_list()
     try:
-        with gzip.open(DB_LIST_FILE_NAME, 'rt') as f:
-            cur_db_list = json.loads(f.read())
-    except:
-        pass
+        new_db_list = load_db_list()
+    except RetryError as e:
+        # a listing outage must not end the run, the current dbs are kept (and rebuilt if forced)
+        logger.error("load db list failed, keep the current list: " + str(e))
+        new_db_list = [dict(d) for d in cur_db_list]
 
     new_db_list.sort(key=lambda d: d['modified'])
-    new_db_list = [d for d in new_db_list
-                   if datetime.datetime.now() - datetime.datetime.fromisoformat(d['modified']) < MODIFIED_LESS_THAN]
+    new_db_list = [d for d in new_db_list if is_recent(d)]
 
     for ndb in new_db_list:
         if db_ids is not None and ndb['id'] not in db_ids:
             continue
-        cdb = next((i for i in cur_db_list if i['id'] == ndb['id']), None)
-        if cdb is None or cdb['modified'] < ndb['modified'] or force_all:  # check corrupted files
-            if cdb is not None:
-                cur_db_list.remove(cdb)
-            cur_db_list.append(ndb)
-            updater = Updater(ndb['id'])
-            updater.prepare_update()
+        update_db(ndb, cur_db_list, force_all)
+
+    log('http stats:', get_stats())
+
+
+def is_recent(db):
+    return datetime.datetime.now() - datetime.datetime.fromisoformat(db['modified']) < MODIFIED_LESS_THAN
+
+
+def read_db_list():
+    try:
+        with gzip.open(DB_LIST_FILE_NAME, 'rt') as f:
+            return json.loads(f.read())
+    except:
+        return []
 
-            with exclusive_lock():
-                updater.update()
-                with gzip.open(DB_LIST_FILE_NAME, 'wt') as f:
-                    cur_db_list.sort(key=lambda d: d['modified'])
-                    f.write(json.dumps(cur_db_list, indent=1))
+
+def update_db(ndb, cur_db_list, force=False):
+    """ rebuilds db if it was modified, cur_db_list is updated and written; returns True if db was rebuilt """
+    cdb = next((i for i in cur_db_list if i['id'] == ndb['id']), None)
+    if not (cdb is None or cdb['modified'] < ndb['modified'] or force):  # check corrupted files
+        return False
+    updater = Updater(ndb['id'])
+    try:
+        updater.prepare_update()
+    except RetryError:
+        logger.exception(ndb['id'] + ": download failed")
+        return False
+    finally:
+        updater.loader.close_parse_pool()
+    ndb['generation'] = updater.generation
+    if cdb is not None:
+        cur_db_list.remove(cdb)
+    cur_db_list.append(ndb)
+
+    with exclusive_lock():
+        updater.update()
+        with gzip.open(DB_LIST_FILE_NAME, 'wt') as f:
+            cur_db_list.sort(key=lambda d: d['modified'])
+            f.write(json.dumps(cur_db_list, indent=1))
+        write_routing(ROUTING_FILE_NAME, [d['id'] for d in cur_db_list])
+
+    if SNAPSHOT_DIR is not None:
+        try:
+            publish(SNAPSHOT_DIR)
+        except OSError:
+            logger.exception(ndb['id'] + ": publish failed")
+    return True
 
 
 class Updater:
@@ -64,6 +112,8 @@ class Updater:
         self.tmp_dir = os.path.join(TMP_DB_DIR, self.symbol.lower())
         self.wrk_dir = os.path.join(WRK_DB_DIR, self.symbol.lower())
         self.batch_size = 1
+        self.generation = read_generation(self.wrk_dir) + 1
+        self.checkpoint = None
 
     def update(self):
         log(self.symbol + ": update")
@@ -74,69 +124,78 @@ class Updater:
         os.makedirs(os.path.dirname(self.wrk_dir), exist_ok=True)
         shutil.move(self.tmp_dir, self.wrk_dir)
 
+    def source(self):
+        """ returns listing of the db and the generation to build, a checkpoint is valid for the same source only """
+        files = sorted([f['name'], f['modified'].isoformat(), f['size']] for f in self.loader.load_file_list())
+        return {'generation': self.generation, 'files': files}
+
+    def remove_files(self, prefix):
+        for fn in os.listdir(self.tmp_dir):
+            if fn.startswith(prefix):
+                os.remove(os.path.join(self.tmp_dir, fn))
+
     def prepare_update(self):
         log(self.symbol + ": prepare update")
-        try:
-            shutil.rmtree(self.tmp_dir)
-        except FileNotFoundError:
-            pass
+        self.checkpoint = Checkpoint(self.tmp_dir, self.source())
+        if self.checkpoint.load():
+            log(self.symbol + ": resume, completed stages:", [s['name'] for s in self.checkpoint.stages])
+        else:
+            try:
+                shutil.rmtree(self.tmp_dir)
+            except FileNotFoundError:
+                pass
         os.makedirs(self.tmp_dir, exist_ok=True)
 
         self.loader.download()
 
-        log(self.symbol + ": calc batch size")
-        series_count = self.loader.approx_series_count()
-        data_count = self.loader.approx_data_count()
-        s_batch_count = series_count // MAX_SERIES_PER_BATCH + 1
-        d_batch_count = data_count // MAX_DATA_PER_BATCH + 1
-        batch_count = max(s_batch_count, d_batch_count, 1)
-        self.batch_size = series_count//batch_count
-        log(self.symbol + ":", "batch_size:", self.batch_size, "batch_count:", batch_count)
+        if not self.checkpoint.done('batch'):
+            log(self.symbol + ": calc batch size")
+            series_count = self.loader.approx_series_count()
+            data_count = self.loader.approx_data_count()
+            s_batch_count = series_count // MAX_SERIES_PER_BATCH + 1
+            d_batch_count = data_count // MAX_DATA_PER_BATCH + 1
+            batch_count = max(s_batch_count, d_batch_count, 1)
+            # counts are estimated (from a sample or the listing sizes), so are the batch sizes
+            log(self.symbol + ":", "approx series count:", series_count, "approx data count:", data_count,
+                "batch_size:", series_count // batch_count, "batch_count:", batch_count)
+            self.checkpoint.complete('batch', data=series_count // batch_count)
+        self.batch_size = self.checkpoint.get('batch')
 
         self.update_meta()
         self.update_series_list()
+        self.update_search()
 
         self.update_data_series(DATA_PREFIX, self.loader.parse_data())
         self.update_data_series(ASPECT_PREFIX, self.loader.parse_aspect())
+        self.update_latest()
 
+        log(self.symbol + ": update changes")
+        write_changes(self.wrk_dir, self.tmp_dir, read_generation(self.wrk_dir), self.generation)
+        write_generation(self.tmp_dir, self.generation)
+        self.checkpoint.remove()
         self.loader.clear()
 
     def update_meta(self):
+        if self.checkpoint.done('meta'):
+            return
         log(self.symbol + ": update meta")
         # load meta
         meta = self.loader.parse_meta()
         meta_fn = os.path.join(self.tmp_dir, META_FILE_NAME)
-        with gzip.open(meta_fn, 'wt') as f:
-            f.write(json.dumps(meta, indent=1))
+        write_gzip(meta_fn, json.dumps(meta, indent=1))
+        self.checkpoint.complete('meta', [META_FILE_NAME])
 
     def update_series_list(self):
-        log(self.symbol + ": update series")
-        # load series
-        batch = []
-        batch_files = []
-        i = 0
-
-        def write_series_batch():
-            fn = os.path.join(self.tmp_dir, TMP_PREFIX + SERIES_PREFIX + str(i) + JSON_GZ_SUFFIX)
-            batch_files.append(fn)
-            batch.sort(key=lambda b: b['id'])
-            with gzip.open(fn, 'wt') as f:
-                for b in batch:
-                    f.write(json.dumps(b) + "\n")
-
-        for s in self.loader.parse_series():
-            batch.append(s)
-            if len(batch) >= self.batch_size:
-                write_series_batch()
-                i += 1
-                batch = []
-        if len(batch) > 0:
-            write_series_batch()
+        if self.checkpoint.done('series'):
+            return
+        if not self.checkpoint.done('series.runs'):
+            self.write_series_runs()
+        batch_files = self.checkpoint.get('series.runs')
 
         log("build sorted index")
 
         def sorted_series_generator():
-            fds = [{"file": gzip.open(b, 'rt'), 'cur': None} for b in batch_files]
+            fds = [{"file": gzip.open(os.path.join(self.tmp_dir, b), 'rt'), 'cur': None} for b in batch_files]
             while True:
                 closed = False
                 for fd in fds:
@@ -156,68 +215,189 @@ class Updater:
                 yield mx['cur']
                 mx['cur'] = None
 
+        self.remove_files(SERIES_PREFIX)
+        self.remove_files(INDEX_PREFIX)
+        shard_files = []
+
+        def write_series_shard_batch():
+            fn = SERIES_PREFIX + batch[0]['id'] + '.' + batch[-1]['id'] + JSON_GZ_SUFFIX
+            write_series_shard(os.path.join(self.tmp_dir, fn), batch)
+            shard_files.extend([fn, series_index_name(fn)])
+
         batch = []
         for s in sorted_series_generator():
             batch.append(s)
             if len(batch) >= self.batch_size:
-                fn = os.path.join(self.tmp_dir, SERIES_PREFIX + batch[0]['id'] + '.' + batch[-1]['id'] + JSON_GZ_SUFFIX)
-                with gzip.open(fn, 'wt') as f:
-                    f.write(array_to_json(batch))
-                i += 1
+                write_series_shard_batch()
                 batch = []
         if len(batch) > 0:
-            fn = os.path.join(self.tmp_dir, SERIES_PREFIX + batch[0]['id'] + '.' + batch[-1]['id'] + JSON_GZ_SUFFIX)
-            with gzip.open(fn, 'wt') as f:
-                f.write(array_to_json(batch))
+            write_series_shard_batch()
 
+        self.checkpoint.complete('series', shard_files)
+        self.checkpoint.release(batch_files)
         for bf in batch_files:
-            os.remove(bf)
+            os.remove(os.path.join(self.tmp_dir, bf))
+
+    def write_series_runs(self):
+        """ writes series to sorted runs of batch_size, merged by update_series_list """
+        log(self.symbol + ": update series")
+        self.remove_files(TMP_PREFIX + SERIES_PREFIX)
+        batch = []
+        batch_files = []
+
+        def write_series_batch():
+            fn = TMP_PREFIX + SERIES_PREFIX + str(len(batch_files)) + JSON_GZ_SUFFIX
+            batch_files.append(fn)
+            batch.sort(key=lambda b: b['id'])
+            with gzip.open(os.path.join(self.tmp_dir, fn), 'wt') as f:
+                for b in batch:
+                    f.write(json.dumps(b) + "\n")
+
+        for s in self.loader.parse_series():
+            batch.append(s)
+            if len(batch) >= self.batch_size:
+                write_series_batch()
+                batch = []
+        if len(batch) > 0:
+            write_series_batch()
+        self.checkpoint.complete('series.runs', batch_files, batch_files)
+
+    def update_search(self):
+        if self.checkpoint.done('search'):
+            return
+        log(self.symbol + ": update search index")
+        with gzip.open(os.path.join(self.tmp_dir, META_FILE_NAME), 'rt') as f:
+            meta = json.loads(f.read())
+        index = build_search_index(self.sorted_series(), meta)
+        write_gzip(os.path.join(self.tmp_dir, SEARCH_FILE_NAME), json.dumps(index))
+        self.checkpoint.complete('search', [SEARCH_FILE_NAME])
+
+    def sorted_series(self):
+        """ generator, returns series from the written series shards """
+        for fn in sorted(fn for fn in os.listdir(self.tmp_dir) if fn.startswith(SERIES_PREFIX)):
+            with gzip.open(os.path.join(self.tmp_dir, fn), 'rt') as f:
+                series = json.loads(f.read())
+            for s in series:
+                yield s
 
     def update_data_series(self, prefix, data_source_generator):
-        log(self.symbol + ":update data " + prefix)
+        aspect = prefix == ASPECT_PREFIX
+        routed = prefix + 'routed'
         batch_files = []
-        for fn in os.listdir(self.tmp_dir):
+        for fn in sorted(os.listdir(self.tmp_dir)):
             if fn.startswith(SERIES_PREFIX):
                 nfp = fn.split('.')
-                batch_fn = os.path.join(self.tmp_dir, TMP_PREFIX + prefix + nfp[1] + '.' + nfp[2] + JSON_GZ_SUFFIX)
                 batch_files.append({
                     'from': nfp[1],
                     'to': nfp[2],
-                    'path': batch_fn,
-                    'fd': gzip.open(batch_fn, 'wt'),
+                    'name': TMP_PREFIX + prefix + nfp[1] + '.' + nfp[2] + TSV_GZ_SUFFIX,
                 })
-        for s in data_source_generator:
-            bf = next((bf for bf in batch_files if bf['from'] <= s['series_id'] <= bf['to']))
-            bf['fd'].write(json.dumps(s) + "\n")
+
+        if not self.checkpoint.done(routed):
+            log(self.symbol + ":update data " + prefix)
+            self.remove_files(TMP_PREFIX + prefix)
+            self.remove_files(prefix)
+            if not aspect:
+                self.remove_files(TMP_LATEST_PREFIX)
+            footnotes = FootnoteTable()
+            for bf in batch_files:
+                bf['path'] = os.path.join(self.tmp_dir, bf['name'])
+            batch_from = [bf['from'] for bf in batch_files]
+            with ShardWriters([bf['path'] for bf in batch_files]) as writers:
+                for s in data_source_generator:
+                    bf = batch_files[bisect.bisect_right(batch_from, s[SERIES_ID]) - 1]
+                    if not bf['from'] <= s[SERIES_ID] <= bf['to']:
+                        raise ValueError("series not found: " + s[SERIES_ID])
+                    writers.write(bf['path'], format_record(s, footnotes))
+            self.checkpoint.complete(routed, [bf['name'] for bf in batch_files], footnotes.codes)
+        footnotes = FootnoteTable(self.checkpoint.get(routed))
 
         log("transform gz to zip")
 
         for bf in batch_files:
-            bf['fd'].close()
-
-            with gzip.open(bf['path'], 'rt') as f:
-                data = f.read()
-            data = data.split('\n')[:-1]
-            if len(data) > 0:
-                data = '[\n' + ',\n'.join(data) + ']'
-                data = json.loads(data)
-                data.sort(key=lambda i: (i['series_id'], i['year'], i['period']))
-
-                zip_file_name = os.path.join(self.tmp_dir, prefix + bf['from'] + '.' + bf['to'] + ZIP_SUFFIX)
-                with zipfile.ZipFile(zip_file_name, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as z:
-                    for s in itertools.groupby(data, key=lambda i:i['series_id']):
-                        # rm duplicates
-                        series = [next(i[1]) for i in itertools.groupby(s[1], key=lambda i: (i['year'], i['period']))]
-                        for i in series:
-                            del i['series_id']
-                        series_fn = s[0] + JSON_SUFFIX
-                        z.writestr(series_fn, array_to_json(series))
-
-            os.remove(bf['path'])
+            shard = prefix + bf['from'] + '.' + bf['to']
+            if self.checkpoint.done(shard):
+                continue
+            batch = RecordBatch(aspect, footnotes)
+            with gzip.open(os.path.join(self.tmp_dir, bf['name']), 'rt') as f:
+                for line in f:
+                    batch.add_line(line)
+            outputs = []
+            if len(batch) > 0:
+                zip_file_name = shard + ZIP_SUFFIX
+                # last observations of each series, joined with series fields by update_latest
+                latest_file_name = TMP_LATEST_PREFIX + bf['from'] + '.' + bf['to'] + JSON_GZ_SUFFIX
+                latest_fd = gzip.open(os.path.join(self.tmp_dir, latest_file_name), 'wt') if not aspect else None
+                with zipfile.ZipFile(os.path.join(self.tmp_dir, zip_file_name), 'w',
+                                     compression=zipfile.ZIP_DEFLATED, compresslevel=9) as z:
+                    for series_id, order in batch.sorted_series():
+                        series = [batch.to_dict(i) for i in order]
+                        z.writestr(zip_member(series_id + JSON_SUFFIX), array_to_json(series), compresslevel=9)
+                        if latest_fd is not None:
+                            latest_fd.write(json.dumps([series_id, latest_observations(series)]) + "\n")
+                outputs.append(zip_file_name)
+                if latest_fd is not None:
+                    latest_fd.close()
+                    outputs.append(latest_file_name)
+            self.checkpoint.complete(shard, outputs)
+            self.checkpoint.release([bf['name']])
+            os.remove(os.path.join(self.tmp_dir, bf['name']))
+
+    def latest_lines(self):
+        """ generator, returns lines of the tmp latest files in series order """
+        for fn in sorted(fn for fn in os.listdir(self.tmp_dir) if fn.startswith(TMP_LATEST_PREFIX)):
+            with gzip.open(os.path.join(self.tmp_dir, fn), 'rt') as f:
+                for line in f:
+                    yield line
+
+    def update_latest(self):
+        """ writes table of the last observations of all series with their facet fields """
+        if self.checkpoint.done('latest'):
+            return
+        log(self.symbol + ": update latest")
+        fields = None
+        rows = []
+        latest = self.latest_lines()
+
+        def next_latest():
+            line = next(latest, None)
+            return json.loads(line) if line is not None else None
+
+        cur = next_latest()
+        for s in self.sorted_series():
+            if fields is None:
+                fields = [k for k in s.keys() if k.endswith('_code') or k == 'seasonal']
+            while cur is not None and cur[0] < s['id']:
+                cur = next_latest()
+            if cur is not None and cur[0] == s['id']:
+                rows.append(json.dumps(cur[0]) + ': ' + json.dumps([[s.get(k) for k in fields], cur[1]]))
+        write_gzip(os.path.join(self.tmp_dir, LATEST_FILE_NAME),
+                   '{"fields": ' + json.dumps(fields or []) + ', "series": {\n' + ',\n'.join(rows) + '}}')
+        self.checkpoint.complete('latest', [LATEST_FILE_NAME])
+        tmp_files = [fn for fn in os.listdir(self.tmp_dir) if fn.startswith(TMP_LATEST_PREFIX)]
+        self.checkpoint.release(tmp_files)
+        for fn in tmp_files:
+            os.remove(os.path.join(self.tmp_dir, fn))
+
+
+def latest_observations(series):
+    """ returns last LATEST_OBSERVATIONS observations of sorted series, annual averages are skipped """
+    observations = [o for o in series if o['period'] not in ANNUAL_PERIODS]
+    if len(observations) == 0:
+        observations = series
+    return observations[-LATEST_OBSERVATIONS:]
+
+
+def zip_member(name):
+    """ returns ZipInfo with a fixed date, so equal shards give equal zip files """
+    info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    return info
 
 
 def array_to_json(arr):
-    return "[\n" + ",\n".join([json.dumps(a) for a in arr]) + "\n]"
+    return dumps(arr)
 
 
 if __name__ == '__main__':
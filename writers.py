@@ -0,0 +1,86 @@
+""" bounded pool of gzip writers for routing records to many shard files. """
+import gzip
+import os
+from collections import OrderedDict
+
+from config import SHARD_WRITERS_MAX_OPEN, SHARD_WRITERS_BUFFER_BYTES
+
+
+TMP_SUFFIX = '.tmp'
+
+
+class ShardWriters:
+    """ appends text to many gzip files, at most max_open of them are open at a time.
+
+    Writes go to per-file buffers. When the buffers together exceed buffer_bytes, the largest one is written
+    out in one piece. A file is reopened in append mode when needed, so it becomes a sequence of gzip
+    members, which gzip.open reads as one stream. The least recently written file is closed to stay
+    within max_open.
+
+    Files are written as <path>.tmp and renamed to their paths by close(), so a path never holds a partial
+    shard: after a crash only .tmp files are left, and an exception inside the `with` block removes them.
+    """
+
+    def __init__(self, paths, max_open=SHARD_WRITERS_MAX_OPEN, buffer_bytes=SHARD_WRITERS_BUFFER_BYTES):
+        self.max_open = max(1, max_open)
+        self.buffer_bytes = buffer_bytes
+        self.buffers = dict()
+        self.total = 0
+        self.files = OrderedDict()
+        self.paths = list(paths)
+        for p in self.paths:
+            with open(p + TMP_SUFFIX, 'wb'):
+                pass
+
+    def write(self, path, s):
+        buf = self.buffers.get(path)
+        if buf is None:
+            buf = self.buffers[path] = bytearray()
+        n = len(buf)
+        buf += s.encode()
+        self.total += len(buf) - n
+        if self.total > self.buffer_bytes:
+            self.flush(max(self.buffers, key=lambda p: len(self.buffers[p])))
+
+    def flush(self, path):
+        data = self.buffers.pop(path)
+        self.total -= len(data)
+        f = self.files.pop(path, None)
+        if f is None:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            f = gzip.open(path + TMP_SUFFIX, 'ab')
+        f.write(data)
+        self.files[path] = f
+
+    def close(self):
+        """ writes out the buffers and moves the files to their paths """
+        for path in sorted(self.buffers.keys()):
+            self.flush(path)
+        self.close_files()
+        for p in self.paths:
+            os.replace(p + TMP_SUFFIX, p)
+
+    def abort(self):
+        """ drops the buffers and removes the written files """
+        self.buffers = dict()
+        self.total = 0
+        self.close_files()
+        for p in self.paths:
+            try:
+                os.remove(p + TMP_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+    def close_files(self):
+        while len(self.files) > 0:
+            self.files.popitem(last=False)[1].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()